@@ -39,6 +39,7 @@ setup(
             'wllvm-sanity-checker = wllvm.sanity:main',
             'extract-bc = wllvm.extractor:main',
             'wparse-args = wllvm.wparser:main',
+            'wllvm-server = wllvm.server:main',
         ],
     },
 
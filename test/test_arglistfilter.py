@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from wllvm.arglistfilter import ArgumentListFilter, splitResponseFile, quoteResponseFileArg, artifactDirEnv
+from wllvm.compilers import ClangBitcodeArgumentListFilter, ClangBuilder, usesEmbeddedBitcode, embedBitcodeEnv
+
+
+# A Linux kernel compile, flags and all.
+kernelCommand = ('-Wp,-MMD,fs/.open.o.d -nostdinc -isystem /usr/lib/gcc/x86_64-linux-gnu/12/include '
+                 '-I./arch/x86/include -I./arch/x86/include/generated -I./include -include ./include/linux/kconfig.h '
+                 '-D__KERNEL__ -Wall -Wundef -Werror=strict-prototypes -Wno-trigraphs -fno-strict-aliasing '
+                 '-fno-common -fshort-wchar -fno-PIE -std=gnu11 -mno-sse -mno-mmx -mno-sse2 -mno-3dnow -mno-avx '
+                 '-m64 -falign-jumps=1 -mno-80387 -mno-fp-ret-in-387 -mpreferred-stack-boundary=3 -mskip-rax-setup '
+                 '-mtune=generic -mno-red-zone -mcmodel=kernel -pipe -mindirect-branch=thunk-extern '
+                 '-mindirect-branch-register -fno-jump-tables -O2 --param=allow-store-data-races=0 '
+                 '-fstack-protector-strong -g -gdwarf-4 -pg -mrecord-mcount -mfentry -DCC_USING_FENTRY '
+                 '-DKBUILD_BASENAME="open" -DKBUILD_MODNAME="open" -c -o fs/open.o fs/open.c').split()
+
+
+class ArgumentListFilterTest(unittest.TestCase):
+
+    def test_kernel_command(self):
+        """
+        The combined pattern dispatches as the individual patterns did
+        """
+        af = ArgumentListFilter(kernelCommand)
+        self.assertEqual(af.inputFiles, ['fs/open.c'])
+        self.assertEqual(af.outputFilename, 'fs/open.o')
+        self.assertTrue(af.isCompileOnly)
+        self.assertEqual(af.linkArgs, ['-m64'])
+        self.assertIn('-fno-jump-tables', af.compileArgs)
+        self.assertIn('-mindirect-branch=thunk-extern', af.compileArgs)
+
+    def test_pattern_order(self):
+        """
+        Earlier patterns win, -Wl, is a link flag even though -W... would match too
+        """
+        af = ArgumentListFilter(['-Wl,-z,now', '-Wall', '-lm', '-L/opt/lib', 'libfoo.so.1.2', 'foo.S'])
+        self.assertEqual(af.linkArgs, ['-Wl,-z,now', '-lm', '-L/opt/lib'])
+        self.assertEqual(af.compileArgs, ['-Wall'])
+        self.assertEqual(af.objectFiles, ['libfoo.so.1.2'])
+        self.assertTrue(af.isAssembly)
+
+    def test_overrides_get_their_own_tables(self):
+        """
+        Subclasses overriding a flag do not leak it into the shared default tables
+        """
+        ClangBitcodeArgumentListFilter(['-c', 'foo.c', '-o', 'foo.o'])
+        af = ArgumentListFilter(['-c', 'foo.c', '-o', 'foo.o'])
+        self.assertEqual(af.outputFilename, 'foo.o')
+        (exact, _, _) = ArgumentListFilter._getTables({}, {})
+        self.assertIs(exact['-o'][1], ArgumentListFilter.outputFileCallback)
+
+    def test_embed_bitcode_conflicts(self):
+        """
+        Flags clang refuses with -fembed-bitcode send the compile down the two compile path
+        """
+        af = ArgumentListFilter(['-mllvm', '-inline-threshold=100', '-c', 'foo.c'])
+        self.assertEqual(af.compileArgs, ['-mllvm', '-inline-threshold=100'])
+        self.assertEqual(af.unrecognizedArgs, [])
+        with mock.patch.dict(os.environ, {embedBitcodeEnv: '1'}):
+            for (flags, embeds) in ((['-O2', '-fPIC'], True), (['-ffunction-sections'], False),
+                                    (['-fdata-sections'], False), (['-mcmodel=large'], False),
+                                    (['-mno-red-zone'], False), (['-mllvm', '-x86-asm-syntax=intel'], False),
+                                    (['-Wa,--noexecstack'], False)):
+                with self.subTest(flags=flags):
+                    builder = ClangBuilder(flags + ['-c', 'foo.c', '-o', 'foo.o'], 'wllvm')
+                    af = builder.getBitcodeArglistFilter()
+                    self.assertEqual(af.conflictsWithEmbeddedBitcode(), not embeds)
+                    self.assertEqual(usesEmbeddedBitcode(builder, af), embeds and builder.isEmbedBitcode())
+
+    def test_lto(self):
+        """
+        -flto and -flto=thin are recognized, for the compile and the link, and -fno-lto undoes them
+        """
+        self.assertFalse(ArgumentListFilter(['-c', 'foo.c', '-fno-strict-aliasing']).isLTO)
+        for flag in ('-flto', '-flto=thin', '-flto=full'):
+            af = ArgumentListFilter([flag, 'foo.c', '-o', 'foo'])
+            self.assertTrue(af.isLTO)
+            self.assertEqual(af.compileArgs, [flag])
+            self.assertEqual(af.linkArgs, [flag])
+        self.assertFalse(ArgumentListFilter(['-flto', '-fno-lto', '-c', 'foo.c']).isLTO)
+        af = ArgumentListFilter(['-flto-jobs=4', '-c', 'foo.c'])
+        self.assertFalse(af.isLTO)
+        self.assertEqual(af.compileArgs, ['-flto-jobs=4'])
+
+    def test_response_files(self):
+        """
+        @file arguments are expanded in place, nested ones too
+        """
+        tmp = tempfile.mkdtemp(suffix='wllvm')
+        try:
+            outer = os.path.join(tmp, 'outer.rsp')
+            inner = os.path.join(tmp, 'inner.rsp')
+            with open(outer, 'w') as f:
+                f.write(f'-DNAME="a b" @{inner}\n-c\n')
+            with open(inner, 'w') as f:
+                f.write("-I'/some dir' foo.c\n")
+            af = ArgumentListFilter([f'@{outer}', '-o', 'foo.o', '@no-such-file'])
+            self.assertEqual(af.compileArgs, ['-DNAME=a b', '-I/some dir', '@no-such-file'])
+            self.assertEqual(af.inputFiles, ['foo.c'])
+            self.assertTrue(af.isCompileOnly)
+
+            # any number of response files side by side, as for long object lists
+            objects = []
+            for i in range(150):
+                with open(os.path.join(tmp, f'{i}.rsp'), 'w') as f:
+                    f.write(f'{i}.o\n')
+                objects.append(f'@{tmp}/{i}.rsp')
+            af = ArgumentListFilter(objects + ['-o', 'prog'])
+            self.assertEqual(af.objectFiles, [f'{i}.o' for i in range(150)])
+
+            # but a cycle is not followed
+            with open(outer, 'w') as f:
+                f.write(f'-DX @{inner}\n')
+            with open(inner, 'w') as f:
+                f.write(f'-DY @{outer} foo.c\n')
+            af = ArgumentListFilter([f'@{outer}', '-c', f'@{inner}'])
+            self.assertEqual(af.compileArgs, ['-DX', '-DY', f'@{outer}', '-DY', '-DX', f'@{inner}'])
+            self.assertEqual(af.inputFiles, ['foo.c', 'foo.c'])
+        finally:
+            shutil.rmtree(tmp)
+
+        args = ['-DX="y z"', "it's", 'back\\slash', '', 'plain']
+        self.assertEqual(splitResponseFile('\n'.join(quoteResponseFileArg(a) for a in args)), args)
+
+    def test_bitcode_compile_args(self):
+        """
+        Dependency generation flags, joined or not, stay out of the bitcode compile
+        """
+        af = ArgumentListFilter(['-Wp,-MMD,.foo.o.d', '-O2', '-MD', '-MF', 'foo.d', '-MTfoo.o', '-MQ', 'x',
+                                 '-DX', '-c', 'foo.c'])
+        self.assertTrue(af.isDependencyOnly)
+        self.assertEqual(af.compileArgs, ['-Wp,-MMD,.foo.o.d', '-O2', '-MD', '-MF', 'foo.d', '-MTfoo.o',
+                                          '-MQ', 'x', '-DX'])
+        self.assertEqual(af.getBitcodeCompileArgs(), ['-O2', '-DX'])
+        self.assertEqual(af.unrecognizedArgs, [])
+
+    def test_precompiled_headers(self):
+        """
+        Uses of a precompiled header are found, and swapped for the bitcode one
+        """
+        tmp = tempfile.mkdtemp(suffix='wllvm')
+        try:
+            header = os.path.join(tmp, 'pre.h')
+            for name in (header, f'{header}.gch'):
+                with open(name, 'w') as f:
+                    f.write('\n')
+            af = ArgumentListFilter(['-O2', '-include', header, '-x', 'c', '-c', 'foo.c',
+                                     '-Xclang', '-include-pch', '-Xclang', f'{header}.gch', '-include', 'other.h'])
+            self.assertEqual([use[2:] for use in af.pchUses], [(header, f'{header}.gch')] * 2)
+            self.assertEqual(af.getBitcodeCompileArgs({header: 'bc.pch'}),
+                             ['-O2', '-include-pch', 'bc.pch', '-x', 'c', '-include', 'other.h'])
+            self.assertEqual(af.getBitcodeCompileArgs({header: None}), af.compileArgs)
+            self.assertEqual(af.getPchBuildArgs(), ['-O2'])
+            af = ArgumentListFilter(['-include', 'first.h', '-Xclang', '-include', '-Xclang', 'second.h',
+                                     '-include-pch', 'other.pch', '-DX', '-c', 'foo.c'])
+            self.assertEqual(af.getPchBuildArgs(), ['-DX'])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_configure_probes(self):
+        """
+        autoconf and CMake checks skip the bitcode phase
+        """
+        probes = [['-c', 'conftest.c'], ['-O2', 'conftest.c', '-o', 'conftest'], ['-c', 'x.c', '-o', 'conftest.o'],
+                  ['-c', '/b/CMakeFiles/CMakeTmp/CheckIncludeFile.c'],
+                  ['-c', '/b/CMakeFiles/CMakeScratch/TryCompile-a1b2c3/src.c', '-o', 'src.o']]
+        for args in probes:
+            self.assertEqual(ArgumentListFilter(args).skipBitcodeGeneration(), (True, 'Configure Probe'), args)
+        for args in (['-c', 'conftestx.c'], ['-c', 'src/CMakeTmpFoo.c']):
+            self.assertEqual(ArgumentListFilter(args).skipBitcodeGeneration(), (False, ''), args)
+
+    def test_artifact_dir(self):
+        """
+        With WLLVM_ARTIFACT_DIR the intermediates go there, named apart by source and output
+        """
+        af = ArgumentListFilter(['a/foo.c', 'b/foo.c', '-o', 'prog'])
+        self.assertEqual(af.getArtifactNames('a/foo.c', True), ['target/.foo.o', 'target/.foo.o.bc'])
+        tmp = tempfile.mkdtemp(suffix='wllvm')
+        try:
+            artifactDir = os.path.join(tmp, 'artifacts')
+            with mock.patch.dict(os.environ, {artifactDirEnv: os.path.relpath(artifactDir)}):
+                (objA, bcA) = af.getArtifactNames('a/foo.c', True)
+                (objB, bcB) = af.getArtifactNames('b/foo.c', True)
+                self.assertTrue(os.path.isdir(artifactDir))
+                self.assertEqual(os.path.dirname(objA), artifactDir)
+                self.assertNotEqual(objA, objB)
+                self.assertEqual((bcA, bcB), (f'{objA}.bc', f'{objB}.bc'))
+                self.assertEqual(af.getArtifactNames('a/foo.c', False)[0], 'foo.o')
+                # the same source built into another output
+                other = ArgumentListFilter(['a/foo.c', '-fPIC', '-o', 'libfoo.so'])
+                self.assertNotEqual(other.getArtifactNames('a/foo.c', True)[0], objA)
+                # and the bitcode of a compile only command
+                pic = ArgumentListFilter(['-c', 'foo.c', '-fPIC', '-o', '.libs/foo.o'])
+                nopic = ArgumentListFilter(['-c', 'foo.c', '-o', 'foo.o'])
+                self.assertEqual(os.path.dirname(pic.getBitcodeFileName()), artifactDir)
+                self.assertNotEqual(pic.getBitcodeFileName(), nopic.getBitcodeFileName())
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_tables_are_shared(self):
+        """
+        The tables are built once per set of overrides, however many filters are made
+        """
+        with mock.patch.object(ArgumentListFilter, '_tables', {}), \
+             mock.patch.object(ArgumentListFilter, '_getDefaultTables',
+                               wraps=ArgumentListFilter._getDefaultTables) as build:
+            for _ in range(3):
+                ArgumentListFilter(kernelCommand)
+                ClangBitcodeArgumentListFilter(['-c', 'foo.c'])
+            self.assertEqual(build.call_count, 2)
+            self.assertEqual(len(ArgumentListFilter._tables), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
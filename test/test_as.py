@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from wllvm.compilers import DragoneggBuilder
+
+
+ir = 'define i32 @foo() {\n  ret i32 1\n}\n'
+
+
+class DragoneggAssemblerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_bitcode_compile_pipes(self):
+        """
+        gcc hands the IR to the assembler through a pipe
+        """
+        self.assertIn('-pipe', DragoneggBuilder(['-c', 'foo.c'], 'wllvm').getBitcodeCompiler())
+
+    @unittest.skipIf(shutil.which('llvm-as') is None, 'needs llvm-as')
+    def test_assembles_stdin(self):
+        """
+        With no input file, as gcc -pipe calls it, the IR streams from stdin to llvm-as
+        """
+        out = os.path.join(self.tmp, 'foo.o')
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env.pop('LLVM_COMPILER_PATH', None)
+        subprocess.run([sys.executable, '-m', 'wllvm.as', '--64', '-o', out], input=ir, text=True,
+                       env=env, check=True)
+        with open(out, 'rb') as f:
+            self.assertEqual(f.read(4), b'BC\xc0\xde')
+
+
+if __name__ == '__main__':
+    unittest.main()
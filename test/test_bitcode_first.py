@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+
+import os
+import unittest
+from unittest import mock
+
+from wllvm.compilers import ClangBuilder, getCodegenArgs, getCodegenCommand, bitcodeFirstEnv
+
+
+class BitcodeFirstTest(unittest.TestCase):
+
+    def builder(self, *args):
+        builder = ClangBuilder(list(args) + ['-c', 'foo.c', '-o', 'foo.o'], 'wllvm')
+        return (builder, builder.getBitcodeArglistFilter())
+
+    def test_codegen_args(self):
+        """
+        Front end flags that do not apply to bitcode are dropped, the code generation ones stay
+        """
+        args = ['-x', 'c', '-std=gnu11', '-ansi', '-xc', '-O2', '-fPIC', '-g', '-DFOO', '-march=native']
+        self.assertEqual(getCodegenArgs(args), ['-O2', '-fPIC', '-g', '-DFOO', '-march=native'])
+
+    def test_codegen_command(self):
+        """
+        The object is lowered from the bitcode with the passes off, under the original flags
+        """
+        (builder, af) = self.builder('-std=c99', '-O2', '-fPIC')
+        with mock.patch.dict(os.environ, {'LLVM_CC_NAME': 'clang-14'}):
+            cmd = getCodegenCommand(builder, af, '.foo.o.bc', 'foo.o')
+        self.assertEqual(cmd, ['clang-14', '-O2', '-fPIC', '-Qunused-arguments', '-Xclang', '-disable-llvm-passes',
+                               '-c', '.foo.o.bc', '-o', 'foo.o'])
+
+    def test_not_with_bitcode_generation_flags(self):
+        """
+        Flags meant for the bitcode alone must not reach the object, so bitcode first is off with them
+        """
+        (builder, _) = self.builder('-O2')
+        with mock.patch.dict(os.environ, {bitcodeFirstEnv: '1', 'LLVM_BITCODE_GENERATION_FLAGS': ''}):
+            self.assertTrue(builder.isBitcodeFirst())
+        with mock.patch.dict(os.environ, {bitcodeFirstEnv: '1', 'LLVM_BITCODE_GENERATION_FLAGS': '-O0 -g'}):
+            self.assertFalse(builder.isBitcodeFirst())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+import errno
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+from wllvm.compilers import wcompile, buildBitcodeFile, getJobCount, jobsEnv
+from wllvm.sections import findElfSection
+
+
+# clang as far as wllvm can tell: the "bitcode" is just another object.
+fakeClang = f'''#!{sys.executable}
+import os, sys
+os.execvp('cc', ['cc'] + [arg for arg in sys.argv[1:] if arg != '-emit-llvm'])
+'''
+
+sources = {
+    'main.c': 'int foo(void);\nint main(void) { return foo(); }\n',
+    'foo.c': 'int foo(void) { return 0; }\n',
+}
+
+
+@unittest.skipIf(shutil.which('cc') is None, 'needs a C compiler')
+class CompileAndLinkTest(unittest.TestCase):
+    """
+    wllvm main.c foo.c -o prog, which builds the hidden objects and links them itself
+    """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+        os.chdir(self.tmp)
+        for (name, source) in sources.items():
+            with open(name, 'w') as f:
+                f.write(source)
+        with open('fake-clang', 'w') as f:
+            f.write(fakeClang)
+        os.chmod('fake-clang', stat.S_IRWXU)
+        self.env = {'LLVM_COMPILER': 'clang', 'LLVM_CC_NAME': 'fake-clang', 'LLVM_COMPILER_PATH': self.tmp}
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def wllvm(self, *args):
+        """
+        Runs wllvm in process, returns its exit code
+        """
+        with mock.patch.dict(os.environ, self.env), mock.patch.object(sys, 'argv', ['wllvm'] + list(args)):
+            try:
+                return wcompile('wllvm')
+            except SystemExit as e:
+                return e.code
+
+    def test_objects_are_built_once_and_linked(self):
+        """
+        The hidden objects carry their bitcode paths, and the program runs
+        """
+        self.assertEqual(self.wllvm('main.c', 'foo.c', '-o', 'prog'), 0)
+        subprocess.check_call(['./prog'])
+        for name in ('main', 'foo'):
+            self.assertIsNotNone(findElfSection(f'target/.{name}.o', '.llvm_bc'))
+
+    def test_failed_attach_falls_back(self):
+        """
+        If the section cannot be written (ENOSPC) the native compile and link still produces the program
+        """
+        full = OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        self.env[jobsEnv] = '1'
+        with mock.patch('wllvm.compilers.addElfSection', side_effect=full), \
+             mock.patch('wllvm.compilers.buildBitcodeFile', wraps=buildBitcodeFile) as bitcode:
+            self.assertEqual(self.wllvm('main.c', 'foo.c', '-o', 'prog'), 0)
+        subprocess.check_call(['./prog'])
+        # the first source fails, its bitcode is not built again, and nothing is left of the attempt
+        self.assertEqual(bitcode.call_count, 1)
+        self.assertEqual(os.listdir('target') if os.path.isdir('target') else [], [])
+
+    def test_failing_source_skips_the_link(self):
+        """
+        On the pool, a source that does not compile decides the exit code, and nothing is linked
+        """
+        with open('bad.c', 'w') as f:
+            f.write('int bad(void) { return }\n')
+        self.env[jobsEnv] = '3'
+        self.assertEqual(self.wllvm('main.c', 'bad.c', 'foo.c', '-o', 'prog'), 1)
+        self.assertFalse(os.path.exists('prog'))
+
+    def test_failed_bitcode_keeps_the_native_exit_code(self):
+        """
+        A single source compile whose bitcode step raises still succeeds, with its object
+        """
+        for concurrent in ('', '1'):
+            with self.subTest(concurrent=concurrent):
+                self.env['WLLVM_CONCURRENT_BITCODE'] = concurrent
+                with mock.patch('wllvm.compilers.storeBitcodeFile', side_effect=RuntimeError('no store')):
+                    self.assertEqual(self.wllvm('-c', 'foo.c', '-o', 'foo.o'), 0)
+                self.assertTrue(os.path.exists('foo.o'))
+                self.assertFalse(os.path.exists('.foo.o.bc'))
+                os.remove('foo.o')
+
+
+class JobCountTest(unittest.TestCase):
+
+    def jobs(self, value, jobs):
+        with mock.patch.dict(os.environ, {jobsEnv: value}), mock.patch('os.cpu_count', return_value=4):
+            return getJobCount(jobs)
+
+    def test_job_count(self):
+        """
+        WLLVM_JOBS, or the cores, bounded by the number of sources and at least one
+        """
+        self.assertEqual(self.jobs('', 10), 4)
+        self.assertEqual(self.jobs('', 2), 2)
+        self.assertEqual(self.jobs('3', 10), 3)
+        self.assertEqual(self.jobs('8', 2), 2)
+        self.assertEqual(self.jobs('0', 10), 1)
+        self.assertEqual(self.jobs('-2', 10), 1)
+        # not a number: warn, and use the cores
+        self.assertEqual(self.jobs('many', 10), 4)
+        self.assertEqual(self.jobs('2.5', 10), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
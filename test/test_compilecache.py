@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from wllvm.arglistfilter import ArgumentListFilter
+from wllvm.compilecache import CompileCache
+
+
+class StubBuilder:
+    """
+    Just enough of a builder for the cache: the system C compiler plays both parts
+    """
+    mode = 'wllvm'
+
+    def getCompiler(self):
+        return ['cc']
+
+    def getBitcodeCompiler(self):
+        return ['cc', '-emit-llvm']
+
+    def isBitcodeFirst(self):
+        return False
+
+
+@unittest.skipIf(shutil.which('cc') is None, 'needs a C compiler to preprocess with')
+class CompileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+        self.cache = CompileCache(os.path.join(self.tmp, 'cache'))
+        self.src = os.path.join(self.tmp, 'foo.c')
+        with open(self.src, 'w') as f:
+            f.write('int foo(void) { return FOO; }\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def key(self, *args):
+        af = ArgumentListFilter(list(args) + ['-c', self.src])
+        return self.cache.getKey(StubBuilder(), af, self.src, os.path.join(self.tmp, '.foo.o.bc'))
+
+    def test_key_follows_the_preprocessed_source_and_flags(self):
+        """
+        Flags that change the preprocessed source, or the compile, change the key
+        """
+        self.assertEqual(self.key('-DFOO=1'), self.key('-DFOO=1'))
+        self.assertNotEqual(self.key('-DFOO=1'), self.key('-DFOO=2'))
+        self.assertNotEqual(self.key('-DFOO=1'), self.key('-DFOO=1', '-O2'))
+
+    def test_store_then_restore(self):
+        """
+        A stored pair comes back byte for byte, a miss restores nothing
+        """
+        objFile = os.path.join(self.tmp, 'foo.o')
+        bcFile = os.path.join(self.tmp, '.foo.o.bc')
+        key = self.key('-DFOO=1')
+        self.assertFalse(self.cache.restore(key, objFile, bcFile))
+        for (name, data) in ((objFile, b'object'), (bcFile, b'bitcode')):
+            with open(name, 'wb') as f:
+                f.write(data)
+        self.cache.store(key, objFile, bcFile)
+        os.remove(objFile)
+        os.remove(bcFile)
+        self.assertTrue(self.cache.restore(key, objFile, bcFile))
+        with open(objFile, 'rb') as f:
+            self.assertEqual(f.read(), b'object')
+        with open(bcFile, 'rb') as f:
+            self.assertEqual(f.read(), b'bitcode')
+
+    def test_restore_replaces_the_files(self):
+        """
+        Restoring renames new files into place, a file linked to the old one keeps its contents
+        """
+        objFile = os.path.join(self.tmp, 'foo.o')
+        bcFile = os.path.join(self.tmp, '.foo.o.bc')
+        key = self.key('-DFOO=1')
+        for (name, data) in ((objFile, b'object'), (bcFile, b'bitcode')):
+            with open(name, 'wb') as f:
+                f.write(data)
+        self.cache.store(key, objFile, bcFile)
+        with open(bcFile, 'wb') as f:
+            f.write(b'older bitcode')
+        entry = os.path.join(self.tmp, 'entry')
+        os.link(bcFile, entry)
+        self.assertTrue(self.cache.restore(key, objFile, bcFile))
+        with open(bcFile, 'rb') as f:
+            self.assertEqual(f.read(), b'bitcode')
+        with open(entry, 'rb') as f:
+            self.assertEqual(f.read(), b'older bitcode')
+        self.assertEqual([name for name in os.listdir(self.tmp) if name.endswith('.tmp')], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
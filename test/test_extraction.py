@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from wllvm.extraction import extract_section_linux, splitBitcodeModules
+
+
+modules = {
+    'foo': 'define i32 @foo() {\n  ret i32 1\n}\n',
+    'main': '@x = global i32 3\ndefine i32 @main() {\n  ret i32 0\n}\n',
+}
+
+
+@unittest.skipIf(shutil.which('llvm-as') is None, 'needs llvm-as')
+class EmbeddedBitcodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+        self.bitcode = {}
+        for (name, ir) in modules.items():
+            ll = os.path.join(self.tmp, f'{name}.ll')
+            with open(ll, 'w') as f:
+                f.write(ir)
+            subprocess.check_call(['llvm-as', ll, '-o', os.path.join(self.tmp, f'{name}.bc')])
+            with open(os.path.join(self.tmp, f'{name}.bc'), 'rb') as f:
+                self.bitcode[name] = f.read()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_split_modules(self):
+        """
+        Concatenated modules, padded or not, come apart as they were
+        """
+        (foo, main) = (self.bitcode['foo'], self.bitcode['main'])
+        self.assertEqual(splitBitcodeModules(foo), [foo])
+        self.assertEqual(splitBitcodeModules(foo + main), [foo, main])
+        self.assertEqual(splitBitcodeModules(main + b'\0' * 12 + foo + foo), [main, foo, foo])
+        self.assertEqual(splitBitcodeModules(b'no bitcode here'), [])
+
+    @unittest.skipIf(shutil.which('llc') is None or shutil.which('objcopy') is None or shutil.which('ld') is None,
+                     'needs llc, objcopy and ld')
+    def test_llvmbc_section(self):
+        """
+        The .llvmbc sections of objects, as clang -fembed-bitcode writes them, and after a relocatable link
+        """
+        objects = []
+        for name in modules:
+            obj = os.path.join(self.tmp, f'{name}.o')
+            subprocess.check_call(['llc', '-filetype=obj', os.path.join(self.tmp, f'{name}.ll'), '-o', obj])
+            subprocess.check_call(['objcopy', '--add-section', f'.llvmbc={self.tmp}/{name}.bc', obj])
+            objects.append(obj)
+
+        def extracted(fileName):
+            contents = []
+            for path in extract_section_linux(fileName):
+                with open(path, 'rb') as f:
+                    contents.append(f.read())
+            return sorted(contents)
+
+        self.assertEqual(extracted(objects[0]), [self.bitcode['foo']])
+        # extracting again does not overwrite the first modules
+        self.assertEqual(len(set(extract_section_linux(objects[0]) + extract_section_linux(objects[0]))), 2)
+        linked = os.path.join(self.tmp, 'linked.o')
+        subprocess.check_call(['ld', '-r'] + objects + ['-o', linked])
+        self.assertEqual(extracted(linked), sorted(self.bitcode.values()))
+
+    @unittest.skipIf(shutil.which('llc') is None or shutil.which('objcopy') is None, 'needs llc and objcopy')
+    def test_llvm_bc_section_wins(self):
+        """
+        An object with both sections yields its bitcode once, from the recorded path
+        """
+        obj = os.path.join(self.tmp, 'foo.o')
+        bcFile = os.path.join(self.tmp, 'foo.bc')
+        pathFile = os.path.join(self.tmp, 'path')
+        with open(pathFile, 'w') as f:
+            f.write(f'{bcFile}\n')
+        subprocess.check_call(['llc', '-filetype=obj', os.path.join(self.tmp, 'foo.ll'), '-o', obj])
+        subprocess.check_call(['objcopy', '--add-section', f'.llvmbc={bcFile}',
+                               '--add-section', f'.llvm_bc={pathFile}', obj])
+        self.assertEqual([path for path in extract_section_linux(obj) if path], [bcFile])
+
+
+if __name__ == '__main__':
+    unittest.main()
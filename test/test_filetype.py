@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+
+from wllvm.filetype import FileType
+
+
+class FileTypeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def assertFileType(self, path, expected):
+        self.assertEqual(FileType.getFileTypeString(FileType.getFileType(path)),
+                         FileType.getFileTypeString(expected))
+
+    def test_mach_headers(self):
+        """
+        Mach-O files are classified by their filetype, in either byte order, and universal
+        binaries by their first architecture
+        """
+        self.assertFileType(self.write('a.o', struct.pack('<IiiI', 0xfeedfacf, 7, 3, 1)), FileType.MACH_OBJECT)
+        self.assertFileType(self.write('a.out', struct.pack('>IiiI', 0xfeedface, 18, 0, 2)), FileType.MACH_EXECUTABLE)
+        self.assertFileType(self.write('a.dylib', struct.pack('<IiiI', 0xfeedfacf, 7, 3, 6)), FileType.MACH_SHARED)
+        fat = struct.pack('>II', 0xcafebabe, 1) + struct.pack('>iiIII', 7, 3, 4096, 16, 12)
+        fat = fat.ljust(4096, b'\0') + struct.pack('<IiiI', 0xfeedfacf, 7, 3, 2)
+        self.assertFileType(self.write('fat', fat), FileType.MACH_EXECUTABLE)
+
+    def test_bitcode(self):
+        """
+        Bitcode, as clang writes it for -flto objects, raw or wrapped
+        """
+        self.assertFileType(self.write('lto.o', b'BC\xc0\xde\x35\x14\x00\x00'), FileType.BITCODE)
+        self.assertFileType(self.write('wrapped.o', struct.pack('<IIIII', 0x0b17c0de, 0, 20, 8, 7) + b'BC\xc0\xde'),
+                            FileType.BITCODE)
+
+    def test_other_files(self):
+        """
+        Text, directories and missing files are all unknown
+        """
+        self.assertFileType(self.write('foo.c', b'int x;\n'), FileType.UNKNOWN)
+        self.assertFileType(self.tmp, FileType.UNKNOWN)
+        self.assertFileType(os.path.join(self.tmp, 'missing'), FileType.UNKNOWN)
+
+    def test_answers_follow_file_changes(self):
+        """
+        The memoized answer is dropped once the file is rewritten
+        """
+        path = self.write('thing', b'!<arch>\n')
+        self.assertFileType(path, FileType.ARCHIVE)
+        self.write('thing', b'!<thin>\n')
+        os.utime(path, ns=(0, 0))
+        self.assertFileType(path, FileType.THIN_ARCHIVE)
+
+    @unittest.skipIf(shutil.which('cc') is None or shutil.which('ar') is None, 'needs a C compiler and ar')
+    def test_elf_and_archives(self):
+        """
+        Objects, executables (pie or not), shared libraries and archives built by the system compiler
+        """
+        src = self.write('foo.c', b'int foo(void) { return 0; }\nint main(void) { return foo(); }\n')
+        def build(name, *args):
+            out = os.path.join(self.tmp, name)
+            subprocess.check_call(['cc'] + list(args) + [src, '-o', out])
+            return out
+        obj = build('foo.o', '-c')
+        self.assertFileType(obj, FileType.ELF_OBJECT)
+        self.assertFileType(build('pie', '-fPIE', '-pie'), FileType.ELF_EXECUTABLE)
+        self.assertFileType(build('nopie', '-no-pie'), FileType.ELF_EXECUTABLE)
+        self.assertFileType(build('libfoo.so', '-fPIC', '-shared'), FileType.ELF_SHARED)
+        archive = os.path.join(self.tmp, 'libfoo.a')
+        subprocess.check_call(['ar', 'rc', archive, obj])
+        self.assertFileType(archive, FileType.ARCHIVE)
+        thin = os.path.join(self.tmp, 'libthin.a')
+        subprocess.check_call(['ar', 'rcT', thin, obj])
+        self.assertFileType(thin, FileType.THIN_ARCHIVE)
+
+
+if __name__ == '__main__':
+    unittest.main()
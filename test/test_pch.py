@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+import errno
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from wllvm.arglistfilter import ArgumentListFilter
+from wllvm.pch import getBitcodePchFile
+
+
+class StubBuilder:
+    """
+    Just enough of a builder for the PCH: the system C compiler builds it
+    """
+    mode = 'wllvm'
+
+    def getBitcodeCompiler(self):
+        return ['cc', '-emit-llvm']
+
+
+@unittest.skipIf(shutil.which('cc') is None, 'needs a C compiler')
+class BitcodePchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+        self.header = os.path.join(self.tmp, 'pre.h')
+        with open(self.header, 'w') as f:
+            f.write('int pre(void);\n')
+        with open(f'{self.header}.gch', 'w') as f:
+            f.write('\n')
+        self.af = ArgumentListFilter(['-O2', '-include', self.header, '-c', 'foo.c'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def pch(self):
+        return getBitcodePchFile(StubBuilder(), self.af, self.header, f'{self.header}.gch', 'foo.c')
+
+    def test_built_once_without_leftovers(self):
+        """
+        The PCH is built, found again, and no lock or temporary is left next to it
+        """
+        pchFile = self.pch()
+        self.assertTrue(os.path.isfile(pchFile))
+        self.assertEqual(self.pch(), pchFile)
+        self.assertEqual(sorted(os.listdir(self.tmp)), sorted(['pre.h', 'pre.h.gch', os.path.basename(pchFile)]))
+
+    def test_no_lock_no_pch(self):
+        """
+        If the lock cannot be taken (e.g. NFS) there is no PCH, and no exception
+        """
+        with mock.patch('fcntl.flock', side_effect=OSError(errno.ENOLCK, os.strerror(errno.ENOLCK))):
+            self.assertIsNone(self.pch())
+        with mock.patch('wllvm.pch.open', side_effect=OSError(errno.EROFS, os.strerror(errno.EROFS)), create=True):
+            self.assertIsNone(self.pch())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from wllvm.arglistfilter import ArgumentListFilter
+from wllvm.policy import Policy, policyEnv
+
+
+class PolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+        self.policyFile = os.path.join(self.tmp, 'policy')
+        with open(self.policyFile, 'w') as f:
+            f.write('# generated and vendored code\n'
+                    'exclude source *.pb.cc\n'
+                    'exclude source */third_party/*\n'
+                    'include source */third_party/ours/*\n'
+                    'exclude output *_test\n'
+                    'exclude flag -DTESTING*\n'
+                    'exclude everything\n')
+        self.oldPolicy = os.environ.get(policyEnv)
+        os.environ[policyEnv] = self.policyFile
+
+    def tearDown(self):
+        if self.oldPolicy is None:
+            del os.environ[policyEnv]
+        else:
+            os.environ[policyEnv] = self.oldPolicy
+        shutil.rmtree(self.tmp)
+
+    def test_rules(self):
+        """
+        The last matching rule decides, malformed lines are dropped
+        """
+        policy = Policy.fromFile(self.policyFile)
+        self.assertEqual(len(policy.rules), 5)
+        self.assertTrue(policy.isExcluded('msg.pb.cc', 'msg.pb.o', []))
+        self.assertTrue(policy.isExcluded('src/third_party/zlib/inflate.c', None, []))
+        self.assertFalse(policy.isExcluded('src/third_party/ours/main.c', None, []))
+        self.assertTrue(policy.isExcluded('main.c', 'main_test', []))
+        self.assertTrue(policy.isExcluded('main.c', 'main.o', ['-O2', '-DTESTING=1']))
+        self.assertFalse(policy.isExcluded('main.c', 'main.o', ['-O2']))
+
+    def test_skip_bitcode(self):
+        """
+        A command skips its bitcode only if all of its sources are excluded
+        """
+        self.assertEqual(ArgumentListFilter(['-c', 'a.pb.cc']).skipBitcodeGeneration(), (True, 'Policy'))
+        self.assertEqual(ArgumentListFilter(['a.pb.cc', 'b.pb.cc', '-o', 'b']).skipBitcodeGeneration(),
+                         (True, 'Policy'))
+        self.assertEqual(ArgumentListFilter(['a.pb.cc', 'main.c', '-o', 'main']).skipBitcodeGeneration(),
+                         (False, ''))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from wllvm.compilers import DragoneggBuilder, canPreprocessOnce, buildFromPreprocessedSource, preprocessOnceEnv
+from wllvm.sections import findElfSection
+
+
+class StubDragoneggBuilder(DragoneggBuilder):
+    """
+    The system C compiler plays both parts, the "bitcode" is just a second object
+    """
+
+    def getCompiler(self):
+        return ['cc']
+
+    def getBitcodeCompiler(self):
+        return ['cc']
+
+
+@unittest.skipIf(shutil.which('cc') is None, 'needs a C compiler')
+class PreprocessOnceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+        self.src = os.path.join(self.tmp, 'foo.c')
+        with open(self.src, 'w') as f:
+            f.write('#include <stddef.h>\nsize_t foo(void) { return FOO; }\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def builder(self, *args):
+        builder = StubDragoneggBuilder(list(args) + ['-c', self.src, '-o', os.path.join(self.tmp, 'foo.o')], 'wllvm')
+        return (builder, builder.getBitcodeArglistFilter())
+
+    def test_only_when_asked_and_safe(self):
+        """
+        Opt in, C family sources, and no dependency files or forced includes
+        """
+        with mock.patch.dict(os.environ, {preprocessOnceEnv: ''}):
+            self.assertFalse(canPreprocessOnce(*self.builder('-DFOO=1')))
+        with mock.patch.dict(os.environ, {preprocessOnceEnv: '1'}):
+            self.assertTrue(canPreprocessOnce(*self.builder('-DFOO=1')))
+            self.assertFalse(canPreprocessOnce(*self.builder('-MD', '-MF', 'foo.d')))
+            self.assertFalse(canPreprocessOnce(*self.builder('-include', 'config.h')))
+            self.assertFalse(canPreprocessOnce(*self.builder('-x', 'c')))
+
+    def test_both_compiles_read_the_preprocessed_source(self):
+        """
+        The object and the bitcode come from one preprocessing run, under the original file name
+        """
+        (builder, af) = self.builder('-DFOO=1', '-g')
+        before = set(os.listdir(tempfile.gettempdir()))
+        self.assertEqual(buildFromPreprocessedSource(builder, af), 0)
+        self.assertEqual(set(os.listdir(tempfile.gettempdir())) - before, set())
+
+        objFile = os.path.join(self.tmp, 'foo.o')
+        bcFile = os.path.join(self.tmp, '.foo.o.bc')
+        self.assertTrue(os.path.exists(bcFile))
+        (size, offset) = findElfSection(objFile, '.llvm_bc')
+        with open(objFile, 'rb') as f:
+            contents = f.read()
+        self.assertEqual(contents[offset:offset + size], f'{bcFile}\n'.encode())
+        # the debug info names the source, not the temporary
+        self.assertIn(b'foo.c', contents)
+        self.assertNotIn(b'.i\0', contents)
+
+
+if __name__ == '__main__':
+    unittest.main()
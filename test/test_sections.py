@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import unittest
+
+from wllvm.sections import addElfSection, findElfSection, findMachSection
+
+
+@unittest.skipIf(shutil.which('cc') is None or shutil.which('objdump') is None,
+                 'needs a C compiler and objdump')
+class ElfSectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def compile(self, name, source):
+        src = os.path.join(self.tmp, f'{name}.c')
+        obj = os.path.join(self.tmp, f'{name}.o')
+        with open(src, 'w') as f:
+            f.write(source)
+        subprocess.check_call(['cc', '-c', src, '-o', obj])
+        return obj
+
+    def section(self, fileName):
+        """
+        The .llvm_bc section as seen by binutils
+        """
+        out = subprocess.check_output(['objdump', '-s', '-j', '.llvm_bc', fileName], text=True)
+        return ''.join(line[43:].strip() for line in out.splitlines() if line.startswith(' 0'))
+
+    def test_added_section_survives_the_link(self):
+        """
+        Sections written in process are readable by objdump, and concatenated by the linker
+        """
+        foo = self.compile('foo', 'int foo(void) { return 1; }\n')
+        main = self.compile('main', 'int foo(void);\nint main(void) { return foo(); }\n')
+        addElfSection(foo, '.llvm_bc', b'/a/foo.bc\n')
+        addElfSection(main, '.llvm_bc', b'/a/main.bc\n')
+        self.assertEqual(self.section(foo), '/a/foo.bc.')
+
+        exe = os.path.join(self.tmp, 'main')
+        subprocess.check_call(['cc', foo, main, '-o', exe])
+        self.assertEqual(self.section(exe), '/a/foo.bc./a/main.bc.')
+
+        for (fileName, data) in ((foo, b'/a/foo.bc\n'), (exe, b'/a/foo.bc\n/a/main.bc\n')):
+            (size, offset) = findElfSection(fileName, '.llvm_bc')
+            with open(fileName, 'rb') as f:
+                f.seek(offset)
+                self.assertEqual(f.read(size), data)
+        self.assertIsNone(findElfSection(foo, '.no_such_section'))
+
+    def test_rejects_non_objects(self):
+        """
+        Anything but a relocatable ELF object is left to objcopy
+        """
+        notElf = os.path.join(self.tmp, 'foo.txt')
+        with open(notElf, 'w') as f:
+            f.write('hello\n')
+        self.assertRaises(ValueError, addElfSection, notElf, '.llvm_bc', b'/a/foo.bc\n')
+
+
+class MachSectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_finds_section_in_anonymous_segment(self):
+        """
+        A 64 bit Mach-O object, with its sections in the usual unnamed segment
+        """
+        sections = [(b'__text', b'__TEXT', 4, 400), (b'__llvm_bc', b'__WLLVM', 10, 404)]
+        segment = struct.pack('<II16sQQQQiiII', 0x19, 72 + 80 * len(sections), b'', 0, 0, 0, 0, 7, 7, len(sections), 0)
+        for (sectname, segname, size, offset) in sections:
+            segment += struct.pack('<16s16sQQIIIIIIII', sectname, segname, 0, size, offset, 0, 0, 0, 0, 0, 0, 0)
+        header = struct.pack('<IiiIIIII', 0xfeedfacf, 0x01000007, 3, 1, 1, len(segment), 0, 0)
+        obj = os.path.join(self.tmp, 'foo.o')
+        with open(obj, 'wb') as f:
+            f.write(header + segment)
+
+        self.assertEqual(findMachSection(obj, '__WLLVM', '__llvm_bc'), (10, 404))
+        self.assertIsNone(findMachSection(obj, '__WLLVM', '__other'))
+        self.assertRaises(ValueError, findElfSection, obj, '.llvm_bc')
+        self.assertRaises(ValueError, findMachSection, os.path.abspath(__file__), '__WLLVM', '__llvm_bc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from wllvm.arglistfilter import ArgumentListFilter
+from wllvm.server import serve, warmUp
+
+
+# python -m wllvm.wllvm without the in process fallback: the server handles it, or it fails.
+serverOnly = '''
+import sys
+import wllvm.wllvm
+from wllvm.client import runOnServer
+sys.argv[0] = wllvm.wllvm.__file__
+rc = runOnServer('wllvm')
+sys.exit(rc if rc is not None else 'wllvm-server did not handle the request')
+'''
+
+
+@unittest.skipIf(shutil.which('cc') is None, 'needs a C compiler')
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+        self.socket = os.path.join(self.tmp, 'wllvm.sock')
+        self.env = dict(os.environ, LLVM_COMPILER='clang', LLVM_CC_NAME='cc',
+                        PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.server = subprocess.Popen([sys.executable, '-m', 'wllvm.server', self.socket], env=self.env)
+        for _ in range(100):
+            if os.path.exists(self.socket):
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        self.server.terminate()
+        self.server.wait()
+        shutil.rmtree(self.tmp)
+
+    def wllvm(self, args, useServer, fallback=True):
+        env = dict(self.env)
+        if useServer:
+            env['WLLVM_SERVER_SOCKET'] = self.socket
+        entry = ['-m', 'wllvm.wllvm'] if fallback else ['-c', serverOnly]
+        return subprocess.run([sys.executable] + entry + args, env=env, cwd=self.tmp,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+    def test_server_matches_in_process(self):
+        """
+        Output, exit code and cwd are those of the in process run, and the server did the work
+        """
+        with open(os.path.join(self.tmp, 'foo.c'), 'w') as f:
+            f.write('int foo(void) { return 1; }\n')
+        for args in (['--version'], ['-E', 'foo.c'], ['-c', 'missing.c']):
+            local = self.wllvm(args, False)
+            remote = self.wllvm(args, True, fallback=False)
+            self.assertEqual(remote.returncode, local.returncode)
+            self.assertEqual(remote.stdout, local.stdout)
+            self.assertEqual(remote.stderr, local.stderr)
+
+    def test_socket_is_private(self):
+        """
+        Only we can connect
+        """
+        self.assertEqual(os.stat(self.socket).st_mode & 0o077, 0)
+
+    def test_falls_back_without_server(self):
+        """
+        A stale socket name means doing the work in process
+        """
+        self.server.terminate()
+        self.server.wait()
+        self.assertEqual(self.wllvm(['--version'], True).returncode, 0)
+
+
+class ServerStartTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_warm_up(self):
+        """
+        The parent builds the argument tables, and the server does so before it listens
+        """
+        with mock.patch.object(ArgumentListFilter, '_tables', {}):
+            warmUp()
+            tables = dict(ArgumentListFilter._tables)
+        self.assertEqual(len(tables), 2)
+        self.assertIn(((), ()), tables)
+        self.assertIn('wllvm.pch', sys.modules)
+        socketName = os.path.join(self.tmp, 'wllvm.sock')
+        with mock.patch('wllvm.server.warmUp', side_effect=RuntimeError('warming up')):
+            self.assertRaises(RuntimeError, serve, socketName)
+        self.assertFalse(os.path.exists(socketName))
+
+    def test_only_replaces_sockets(self):
+        """
+        A file that is not a socket is left alone, and the server does not start
+        """
+        socketName = os.path.join(self.tmp, 'wllvm.sock')
+        with open(socketName, 'w') as f:
+            f.write('not a socket\n')
+        with mock.patch('wllvm.server.warmUp'):
+            self.assertRaises(SystemExit, serve, socketName)
+        with open(socketName) as f:
+            self.assertEqual(f.read(), 'not a socket\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
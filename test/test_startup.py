@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import subprocess
+import sys
+import time
+import unittest
+
+from wllvm.compilers import getParentCommand
+
+
+class StartupTest(unittest.TestCase):
+
+    def test_parent_command(self):
+        """
+        The ccache check agrees with ps
+        """
+        if shutil.which('ps') is None:
+            self.skipTest('needs ps')
+        ps = subprocess.check_output(['ps', '-o', 'comm=', '-p', str(os.getppid())], text=True)
+        # /proc/<pid>/comm is truncated to 15 characters
+        self.assertEqual(getParentCommand(os.getppid()), os.path.basename(ps.strip())[:15])
+
+    @unittest.skipUnless(os.path.exists(f'/proc/{os.getpid()}/comm'), 'needs procfs')
+    def test_parent_command_overhead(self):
+        """
+        The ccache check, paid by every wllvm invocation, does not spawn a process
+        """
+        calls = 100
+        start = time.perf_counter()
+        for _ in range(calls):
+            getParentCommand(os.getppid())
+        perCall = (time.perf_counter() - start) / calls
+        print(f'\nccache parent check: {perCall * 1e6:.1f}us per call')
+        # spawning ps takes milliseconds
+        self.assertLess(perCall, 0.001)
+
+
+@unittest.skipIf(shutil.which('cc') is None, 'needs a C compiler')
+class ImportTimeTest(unittest.TestCase):
+
+    # Only the bitcode path, or opt in features, should pay for these.
+    lazyModules = ['hashlib', 'tempfile', 'shutil', 'pprint', 'concurrent.futures', 'json', 'socket']
+
+    def importTimes(self, args):
+        """
+        Runs wllvm under python -X importtime, returns {module: self time in us}
+        """
+        env = dict(os.environ, LLVM_COMPILER='clang', LLVM_CC_NAME='cc',
+                   PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        env.pop('WLLVM_SERVER_SOCKET', None)
+        env.pop('WLLVM_CACHE_DIR', None)
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-m', 'wllvm.wllvm'] + args, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        times = {}
+        for line in proc.stderr.splitlines():
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+            (selfTime, _, module) = line[len('import time:'):].split('|')
+            times[module.strip()] = int(selfTime)
+        return times
+
+    def test_no_bitcode_path_imports(self):
+        """
+        The fixed cost of an invocation that never builds bitcode
+        """
+        for args in (['--version'], ['-E', '-x', 'c', '/dev/null']):
+            times = self.importTimes(args)
+            wllvmTime = sum(t for (m, t) in times.items() if m.startswith('wllvm'))
+            print(f'\nwllvm {" ".join(args)}: {len(times)} modules imported in {sum(times.values())}us, '
+                  f'{wllvmTime}us of which in wllvm itself')
+            self.assertIn('wllvm.compilers', times)
+            for module in self.lazyModules:
+                self.assertNotIn(module, times)
+
+
+@unittest.skipIf(shutil.which('cc') is None, 'needs a C compiler')
+class SkipPathTest(unittest.TestCase):
+
+    def test_nothing_on_stderr(self):
+        """
+        Commands that build no bitcode are as quiet as the compiler, configure checks look at stderr
+        """
+        env = dict(os.environ, LLVM_COMPILER='clang', LLVM_CC_NAME='cc',
+                   PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        for key in ('WLLVM_SERVER_SOCKET', 'WLLVM_CACHE_DIR', 'WLLVM_OUTPUT', 'WLLVM_OUTPUT_LEVEL', 'WLLVM_OUTPUT_FILE'):
+            env.pop(key, None)
+        for args in (['--version'], ['-E', '-x', 'c', '/dev/null'], ['-M', '-x', 'c', '/dev/null']):
+            proc = subprocess.run([sys.executable, '-m', 'wllvm.wllvm'] + args, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+            self.assertEqual(proc.returncode, 0)
+            self.assertEqual(proc.stderr, '', args)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import lzma
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from wllvm.store import storeBitcodeFile, placeFile, getHashedPathName, getCompression, storeEnv, compressionEnv
+from wllvm.extraction import getStorePath, resolveBitcodePaths
+
+
+class StoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+        self.storeDir = os.path.join(self.tmp, 'store')
+        os.mkdir(self.storeDir)
+        self.bcFile = os.path.join(self.tmp, '.foo.o.bc')
+        self.entry = os.path.join(self.storeDir, getHashedPathName(self.bcFile))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, data):
+        # like clang, replace the file rather than rewrite it
+        with open(f'{path}.new', 'wb') as f:
+            f.write(data)
+        os.replace(f'{path}.new', path)
+
+    def store(self, compression=''):
+        with mock.patch.dict(os.environ, {storeEnv: self.storeDir, compressionEnv: compression}):
+            storeBitcodeFile(self.bcFile)
+
+    def test_store_and_update(self):
+        """
+        Entries follow the bitcode, and nothing but the entries is left in the store
+        """
+        self.write(self.bcFile, b'BC\xc0\xde one')
+        self.store()
+        with open(self.entry, 'rb') as f:
+            self.assertEqual(f.read(), b'BC\xc0\xde one')
+        self.write(self.bcFile, b'BC\xc0\xde two')
+        self.store()
+        with open(self.entry, 'rb') as f:
+            self.assertEqual(f.read(), b'BC\xc0\xde two')
+        self.assertEqual(os.listdir(self.storeDir), [os.path.basename(self.entry)])
+
+    def test_temporaries_are_unique(self):
+        """
+        A temporary named after a pid, as another host sharing the store may have, is not touched
+        """
+        self.write(self.bcFile, b'BC\xc0\xde mine')
+        theirs = f'{self.entry}.{os.getpid()}.tmp'
+        with open(theirs, 'wb') as f:
+            f.write(b'BC\xc0\xde theirs')
+        self.store()
+        with open(theirs, 'rb') as f:
+            self.assertEqual(f.read(), b'BC\xc0\xde theirs')
+        with open(self.entry, 'rb') as f:
+            self.assertEqual(f.read(), b'BC\xc0\xde mine')
+        self.assertEqual(sorted(os.listdir(self.storeDir)), sorted([os.path.basename(self.entry), os.path.basename(theirs)]))
+
+    def test_identical_entries_are_left_alone(self):
+        """
+        Storing the same contents again does not write the entry
+        """
+        self.write(self.bcFile, b'BC\xc0\xde same')
+        with open(self.entry, 'wb') as f:
+            f.write(b'BC\xc0\xde same')
+        before = os.stat(self.entry)
+        with mock.patch('wllvm.store.placeFile') as place:
+            self.store()
+            place.assert_not_called()
+        self.assertEqual(os.stat(self.entry).st_ino, before.st_ino)
+
+    def test_place_file_falls_back_to_a_copy(self):
+        """
+        Without reflinks the contents are copied, never linked
+        """
+        self.write(self.bcFile, b'BC\xc0\xde copied')
+        dst = os.path.join(self.storeDir, 'copy')
+        with mock.patch('fcntl.ioctl', side_effect=OSError):
+            self.assertEqual(placeFile(self.bcFile, dst), 'copy')
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), b'BC\xc0\xde copied')
+        self.assertNotEqual(os.stat(dst).st_ino, os.stat(self.bcFile).st_ino)
+        self.assertIn(placeFile(self.bcFile, os.path.join(self.storeDir, 'shared')), ('reflink', 'copy'))
+
+    def test_compressed_entries(self):
+        """
+        Compressed entries replace the plain one, and are read back decompressed, in parallel
+        """
+        bitcode = b'BC\xc0\xde' + bytes(range(256)) * 256
+        self.write(self.bcFile, bitcode)
+        self.store()
+        for (compression, suffix) in (('zlib', '.zlib'), ('lzma:1', '.xz'), ('zlib:9', '.zlib')):
+            self.store(compression)
+            self.assertEqual(os.listdir(self.storeDir), [os.path.basename(self.entry) + suffix])
+            self.assertLess(os.path.getsize(self.entry + suffix), len(bitcode) // 10)
+            with mock.patch.dict(os.environ, {storeEnv: self.storeDir}):
+                self.assertEqual(getStorePath(self.bcFile), self.entry + suffix)
+                # once the bitcode itself is gone
+                os.rename(self.bcFile, f'{self.bcFile}.away')
+                try:
+                    for path in resolveBitcodePaths([self.bcFile] * 4):
+                        with open(path, 'rb') as f:
+                            self.assertEqual(f.read(), bitcode)
+                finally:
+                    os.rename(f'{self.bcFile}.away', self.bcFile)
+        # the same contents are not compressed again
+        with mock.patch('wllvm.store.compressFile') as compress:
+            self.store('zlib:9')
+            compress.assert_not_called()
+
+    def test_compression_levels(self):
+        """
+        Levels out of range, or a failing compressor, leave a plain entry and do not fail the store
+        """
+        self.write(self.bcFile, b'BC\xc0\xde plain')
+        for value in ('zlib:42', 'zlib:-2', 'lzma:10', 'lzma:-1'):
+            with mock.patch.dict(os.environ, {compressionEnv: value}):
+                self.assertIsNone(getCompression())
+        with mock.patch.dict(os.environ, {compressionEnv: 'zlib:-1'}):
+            self.assertEqual(getCompression(), ('zlib', -1))
+        self.store('zlib:42')
+        self.assertEqual(os.listdir(self.storeDir), [os.path.basename(self.entry)])
+        with mock.patch('zlib.compressobj', side_effect=ValueError('Invalid initialization option')):
+            self.store('zlib')
+        with mock.patch('lzma.LZMACompressor', side_effect=lzma.LZMAError('Invalid or unsupported options')):
+            self.store('lzma')
+        self.assertEqual(os.listdir(self.storeDir), [os.path.basename(self.entry)])
+
+
+if __name__ == '__main__':
+    unittest.main()
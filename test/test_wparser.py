@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+
+class BatchParseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(suffix='wllvm')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def batch(self, inputFile):
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        proc = subprocess.run([sys.executable, '-m', 'wllvm.wparser', '--batch', inputFile], env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True)
+        return ([json.loads(line) for line in proc.stdout.splitlines()], proc.stderr)
+
+    def test_compile_commands(self):
+        """
+        Both the arguments and the command forms, with the command's directory honoured
+        """
+        with open(os.path.join(self.tmp, 'flags.rsp'), 'w') as f:
+            f.write('-DFROM_RSP -O2\n')
+        entries = [
+            {'directory': self.tmp, 'file': 'foo.c',
+             'arguments': ['cc', '@flags.rsp', '-c', 'foo.c', '-o', 'foo.o', '-fancy-new-flag']},
+            {'directory': self.tmp, 'file': 'bar.c', 'command': 'cc "bar.c" -DNAME="a b" -E'},
+        ]
+        commands = os.path.join(self.tmp, 'compile_commands.json')
+        with open(commands, 'w') as f:
+            json.dump(entries, f)
+
+        ([foo, bar], report) = self.batch(commands)
+        self.assertEqual(foo['compileArgs'], ['-DFROM_RSP', '-O2', '-fancy-new-flag'])
+        self.assertEqual(foo['inputFiles'], ['foo.c'])
+        self.assertEqual(foo['outputFilename'], 'foo.o')
+        self.assertIsNone(foo['skipReason'])
+        self.assertEqual(foo['unrecognizedArgs'], [])
+        self.assertEqual(bar['compileArgs'], ['-DNAME=a b'])
+        self.assertEqual(bar['skipReason'], 'Preprocess Only')
+        self.assertIn('Parsed 2 commands', report)
+
+    def test_jsonl_argvs(self):
+        """
+        One argv per line, unrecognized flags are counted
+        """
+        argvs = os.path.join(self.tmp, 'argvs.jsonl')
+        with open(argvs, 'w') as f:
+            for i in range(3):
+                f.write(json.dumps(['cc', '-c', f'f{i}.c', '--no-such-flag']) + '\n')
+        (partitions, report) = self.batch(argvs)
+        self.assertEqual([p['inputFiles'] for p in partitions], [['f0.c'], ['f1.c'], ['f2.c']])
+        self.assertEqual(partitions[0]['unrecognizedArgs'], ['--no-such-flag'])
+        self.assertIn('3  --no-such-flag', report)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,90 @@ import os
 import re
 import sys
 
+from .policy import getPolicy
+
 # Internal logger
 _logger = logging.getLogger(__name__)
 
 # Flag for dumping
 DUMPING = False
 
+# Response files nested deeper than this are not expanded.
+maxResponseFileDepth = 100
+
+# Environmental variable naming a directory for our intermediate objects and bitcode.
+artifactDirEnv = 'WLLVM_ARTIFACT_DIR'
+
+# Characters that need escaping in a response file.
+_responseFileSpecials = frozenset(' \t\n\r\f\v\'"\\')
+
+# Compile flags clang refuses together with -fembed-bitcode (err_drv_unsupported_embed_bitcode),
+# exactly and by prefix.
+embedBitcodeConflicts = frozenset(('-ffunction-sections', '-fdata-sections', '-mno-red-zone', '-mllvm'))
+embedBitcodeConflictPrefixes = ('-mcmodel=', '-Wa,')
+
+def splitResponseFile(text):
+    """ Splits the contents of a response file the way gcc and clang do.
+
+    Arguments are separated by whitespace, quotes group, and a backslash
+    escapes the next character.
+    """
+    if not any(c in text for c in '\'"\\'):
+        return text.split()
+    args = []
+    arg = None
+    quote = None
+    chars = iter(text)
+    for c in chars:
+        if c == '\\':
+            arg = (arg or '') + next(chars, '')
+        elif quote:
+            if c == quote:
+                quote = None
+            else:
+                arg += c
+        elif c in '\'"':
+            quote = c
+            arg = arg or ''
+        elif c.isspace():
+            if arg is not None:
+                args.append(arg)
+                arg = None
+        else:
+            arg = (arg or '') + c
+    if arg is not None:
+        args.append(arg)
+    return args
+
+def quoteResponseFileArg(arg):
+    """ The inverse of splitResponseFile, for a single argument.
+    """
+    if not arg:
+        return '""'
+    if _responseFileSpecials.isdisjoint(arg):
+        return arg
+    return ''.join(f'\\{c}' if c in _responseFileSpecials else c for c in arg)
+
+def getArtifactDir():
+    """ Returns the absolute WLLVM_ARTIFACT_DIR, created if need be, or None if it is not set.
+    """
+    artifactDir = os.getenv(artifactDirEnv)
+    if not artifactDir:
+        return None
+    artifactDir = os.path.abspath(artifactDir)
+    os.makedirs(artifactDir, exist_ok=True)
+    return artifactDir
+
+def getArtifactKey(*paths):
+    """ A hash of the absolute paths, so artifacts of different sources never collide.
+    """
+    import hashlib
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(os.path.abspath(path).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()[:16]
+
 # This class applies filters to GCC argument lists.  It has a few
 # default arguments that it records, but does not modify the argument
 # list at all.  It can be subclassed to change this behavior.
@@ -27,8 +105,43 @@ DUMPING = False
 # recognized by regular expressions.  All regular expressions must be
 # tried, obviously.  The first one that matches is taken, and no order
 # is specified.  Try to avoid overlapping patterns.
+#
+# The tables are built once per set of overrides and shared by every
+# instance; the patterns are combined into a single alternation, so an
+# argument is matched against all of them in one go.
 class ArgumentListFilter:
-    def __init__(self, inputList, exactMatches={}, patternMatches={}):
+
+    __slots__ = ('cratetype', 'emittype', 'cratename', 'outdir', 'extrafilename', 'outputBCname',
+                 'inputList', 'inputFiles', 'objectFiles', 'outputFilename',
+                 'compileArgs', 'linkArgs', 'forbiddenArgs', 'unrecognizedArgs',
+                 'isVerbose', 'isDependencyOnly', 'isPreprocessOnly', 'isAssembleOnly',
+                 'isAssembly', 'isCompileOnly', 'isEmitLLVM', 'isStandardIn', 'isLTO',
+                 'dependencyArgPositions', 'pchUses', '_inputArgs', '_responseFiles')
+
+    # (exactMatches, patternMatches) overrides -> (exact table, combined pattern, pattern handlers)
+    _tables = {}
+
+    @staticmethod
+    def _getTables(exactMatches, patternMatches):
+        key = (tuple(exactMatches.items()), tuple(patternMatches.items()))
+        tables = ArgumentListFilter._tables.get(key)
+        if tables is None:
+            (defaultArgExactMatches, defaultArgPatterns) = ArgumentListFilter._getDefaultTables()
+            argExactMatches = dict(defaultArgExactMatches)
+            argExactMatches.update(exactMatches)
+            argPatterns = dict(defaultArgPatterns)
+            argPatterns.update(patternMatches)
+            # Each pattern gets a named group of its own. The alternation is tried
+            # in order, as the patterns were; lastgroup names the one that matched
+            # since the wrapper group is the last to close.
+            combined = re.compile('|'.join(f'(?P<p{i}>{pattern})' for (i, pattern) in enumerate(argPatterns)))
+            handlers = {f'p{i}': action for (i, action) in enumerate(argPatterns.values())}
+            tables = (argExactMatches, combined, handlers)
+            ArgumentListFilter._tables[key] = tables
+        return tables
+
+    @staticmethod
+    def _getDefaultTables():
         defaultArgExactMatches = {
 
             '-' : (0, ArgumentListFilter.standardInCallback),
@@ -120,7 +233,8 @@ class ArgumentListFilter:
             # Include
             '-I' : (1, ArgumentListFilter.compileBinaryCallback),
             '-idirafter' : (1, ArgumentListFilter.compileBinaryCallback),
-            '-include' : (1, ArgumentListFilter.compileBinaryCallback),
+            '-include' : (1, ArgumentListFilter.includeBinaryCallback),
+            '-include-pch' : (1, ArgumentListFilter.includePchBinaryCallback),
             '-imacros' : (1, ArgumentListFilter.compileBinaryCallback),
             '-iprefix' : (1, ArgumentListFilter.compileBinaryCallback),
             '-iwithprefix' : (1, ArgumentListFilter.compileBinaryCallback),
@@ -176,7 +290,8 @@ class ArgumentListFilter:
             '-Ofast' : (0, ArgumentListFilter.compileUnaryCallback),
             '-Og' : (0, ArgumentListFilter.compileUnaryCallback),
             # Component-specifiers
-            '-Xclang' : (1, ArgumentListFilter.compileBinaryCallback),
+            '-Xclang' : (1, ArgumentListFilter.xclangBinaryCallback),
+            '-mllvm' : (1, ArgumentListFilter.compileBinaryCallback),
             '-Xpreprocessor' : (1, ArgumentListFilter.defaultBinaryCallback),
             '-Xassembler' : (1, ArgumentListFilter.defaultBinaryCallback),
             '-Xlinker' : (1, ArgumentListFilter.defaultBinaryCallback),
@@ -260,6 +375,10 @@ class ArgumentListFilter:
         # - optimiziation and other flags: -f...
         #
         defaultArgPatterns = {
+            # Dependency generation: joined forms, and the kernel's -Wp,-MD,file.
+            # These come first, -MTfoo.o is not an object file.
+            r'^-M[FTQ].+$' : (0, ArgumentListFilter.dependencyOnlyCallback),
+            r'^-Wp,-M(M)?D,.+$' : (0, ArgumentListFilter.dependencyOnlyCallback),
             r'^.+\.(c|cc|cpp|C|cxx|i|s|S|bc)$' : (0, ArgumentListFilter.inputFileCallback),
             # FORTRAN file types
             r'^.+\.([fF](|[0-9][0-9]|or|OR|pp|PP))$' : (0, ArgumentListFilter.inputFileCallback),
@@ -277,6 +396,8 @@ class ArgumentListFilter:
             r'^-Wl,(?!-gc-sections).+$' : (0, ArgumentListFilter.linkUnaryCallback),
             r'^-W(?!l,).*$' : (0, ArgumentListFilter.compileUnaryCallback),
             r'^-fsanitize=.+$' : (0, ArgumentListFilter.compileLinkUnaryCallback),
+            # with -flto the "object" clang writes is already bitcode
+            r'^-f(no-)?lto(=.+)?$' : (0, ArgumentListFilter.ltoCallback),
             r'^-f.+$' : (0, ArgumentListFilter.compileUnaryCallback),
             r'^-rtlib=.+$' : (0, ArgumentListFilter.linkUnaryCallback),
             r'^-std=.+$' : (0, ArgumentListFilter.compileUnaryCallback),
@@ -314,6 +435,11 @@ class ArgumentListFilter:
 
         }
 
+        return (defaultArgExactMatches, defaultArgPatterns)
+
+    def __init__(self, inputList, exactMatches={}, patternMatches={}):
+        (argExactMatches, argPatterns, patternHandlers) = self._getTables(exactMatches, patternMatches)
+
         # rust stuff...
         self.cratetype = ''
         self.emittype = ''
@@ -333,6 +459,12 @@ class ArgumentListFilter:
         self.linkArgs = []
         # currently only dead_strip belongs here; but I guess there could be more.
         self.forbiddenArgs = []
+        # flags we kept as compile flags without knowing what they are.
+        self.unrecognizedArgs = []
+        # where in compileArgs the dependency generation flags are, the bitcode compile drops them.
+        self.dependencyArgPositions = set()
+        # precompiled headers used, as (position in compileArgs, number of args, header, native pch)
+        self.pchUses = []
 
 
         self.isVerbose = False
@@ -343,13 +475,11 @@ class ArgumentListFilter:
         self.isCompileOnly = False
         self.isEmitLLVM = False
         self.isStandardIn = False
-
-        argExactMatches = dict(defaultArgExactMatches)
-        argExactMatches.update(exactMatches)
-        argPatterns = dict(defaultArgPatterns)
-        argPatterns.update(patternMatches)
+        self.isLTO = False
 
         self._inputArgs = collections.deque(inputList)
+        # the response files being expanded, as (real path, args left once it is done)
+        self._responseFiles = []
 
         #iam: parse the cmd line, bailing if we discover that there will be no second phase.
         while (self._inputArgs   and
@@ -377,18 +507,19 @@ class ArgumentListFilter:
                 if not terminated:
                     _logger.warning('Did not find a closing "-Wl,--end-group" to match "-Wl,--start-group"')
                 self.linkingGroupCallback(linkingGroup)
+            elif currentItem.startswith('@') and os.path.isfile(currentItem[1:]):
+                self.responseFileCallback(currentItem)
             else:
-                matched = False
-                for pattern, (arity, handler) in argPatterns.items():
-                    if re.match(pattern, currentItem):
-                        flagArgs = self._shiftArgs(arity)
-                        handler(self, currentItem, *flagArgs)
-                        matched = True
-                        break
+                m = argPatterns.match(currentItem)
+                if m:
+                    (arity, handler) = patternHandlers[m.lastgroup]
+                    flagArgs = self._shiftArgs(arity)
+                    handler(self, currentItem, *flagArgs)
                 # If no action has been specified, this is a zero-argument
                 # flag that we should just keep.
-                if not matched:
+                else:
                     _logger.warning('Did not recognize the compiler flag "%s"', currentItem)
+                    self.unrecognizedArgs.append(currentItem)
                     self.compileUnaryCallback(currentItem)
 
         if DUMPING:
@@ -399,8 +530,12 @@ class ArgumentListFilter:
         retval = (False, "")
         if os.environ.get('WLLVM_CONFIGURE_ONLY', False):
             retval = (True, "CFG Only")
+        elif self.isConfigureProbe():
+            retval = (True, "Configure Probe")
         elif not self.inputFiles:
             retval = (True, "No input files")
+        elif self.isExcludedByPolicy():
+            retval = (True, "Policy")
         elif self.isEmitLLVM:
             retval = (True, "Emit LLVM")
         elif self.isAssembly or self.isAssembleOnly:
@@ -413,6 +548,40 @@ class ArgumentListFilter:
             retval = (True, "Dependency Only")
         return retval
 
+    def conflictsWithEmbeddedBitcode(self):
+        """ Whether a compile flag is one clang will not combine with -fembed-bitcode.
+        """
+        return any(arg in embedBitcodeConflicts or arg.startswith(embedBitcodeConflictPrefixes)
+                   for arg in self.compileArgs)
+
+    def isConfigureProbe(self):
+        """ Recognizes the throwaway compiles of autoconf and CMake checks.
+
+        autoconf compiles conftest.c (to conftest.o or conftest), CMake's
+        try_compile builds in CMakeFiles/CMakeTmp or CMakeFiles/CMakeScratch/TryCompile-*.
+        Nobody will ever want their bitcode.
+        """
+        paths = list(self.inputFiles)
+        if self.outputFilename:
+            paths.append(self.outputFilename)
+        for path in paths:
+            base = os.path.basename(path)
+            if base == 'conftest' or base.startswith('conftest.'):
+                return True
+        cmakeTmp = os.path.join(os.sep, 'CMakeFiles', 'CMakeTmp', '')
+        tryCompile = os.path.join(os.sep, 'TryCompile-')
+        for path in paths + [os.getcwd()]:
+            path = os.path.join(os.path.abspath(path), '')
+            if cmakeTmp in path or tryCompile in path:
+                return True
+        return False
+
+    def isExcludedByPolicy(self):
+        """ Whether the WLLVM_POLICY file excludes all the sources of this command.
+        """
+        policy = getPolicy()
+        return policy is not None and policy.excludes(self)
+
     def _shiftArgs(self, nargs):
         ret = []
         while nargs > 0:
@@ -422,6 +591,32 @@ class ArgumentListFilter:
         return ret
 
 
+    def responseFileCallback(self, flag):
+        """ Splices the contents of @file into the arguments still to be parsed,
+        so they are matched (and any @file in them expanded) as they come up.
+
+        Any number of response files can follow each other, only nesting is
+        limited: a file that includes itself, or nesting deeper than
+        maxResponseFileDepth, is not expanded.
+        """
+        _logger.debug('responseFileCallback: %s', flag)
+        # the files whose arguments have all been parsed are done
+        while self._responseFiles and self._responseFiles[-1][1] > len(self._inputArgs):
+            self._responseFiles.pop()
+        path = os.path.realpath(flag[1:])
+        if any(path == active for (active, _) in self._responseFiles):
+            _logger.warning('Not expanding "%s", it includes itself', flag)
+            self.compileUnaryCallback(flag)
+            return
+        if len(self._responseFiles) >= maxResponseFileDepth:
+            _logger.warning('Not expanding "%s", response files nested too deep', flag)
+            self.compileUnaryCallback(flag)
+            return
+        with open(flag[1:]) as f:
+            args = splitResponseFile(f.read())
+        self._responseFiles.append((path, len(self._inputArgs)))
+        self._inputArgs.extendleft(reversed(args))
+
     def standardInCallback(self, flag):
         _logger.debug('standardInCallback: %s', flag)
         self.isStandardIn = True
@@ -433,7 +628,7 @@ class ArgumentListFilter:
     def inputFileCallback(self, infile):
         _logger.debug('Input file: %s', infile)
         self.inputFiles.append(infile)
-        if re.search('\\.(s|S)$', infile):
+        if infile.endswith(('.s', '.S')):
             self.isAssembly = True
 
     def outputFileCallback(self, flag, filename):
@@ -451,6 +646,7 @@ class ArgumentListFilter:
     def dependencyOnlyCallback(self, flag):
         _logger.debug('dependencyOnlyCallback: %s', flag)
         self.isDependencyOnly = True
+        self.dependencyArgPositions.add(len(self.compileArgs))
         self.compileArgs.append(flag)
 
     def assembleOnlyCallback(self, flag):
@@ -470,6 +666,13 @@ class ArgumentListFilter:
         self.isEmitLLVM = True
         self.isCompileOnly = True
 
+    def ltoCallback(self, flag):
+        _logger.debug('ltoCallback: %s', flag)
+        # the last of -flto, -flto=thin and -fno-lto wins, as with the compiler
+        self.isLTO = not flag.startswith('-fno-')
+        self.compileArgs.append(flag)
+        self.linkArgs.append(flag)
+
     def linkUnaryCallback(self, flag):
         _logger.debug('linkUnaryCallback: %s', flag)
         self.linkArgs.append(flag)
@@ -494,9 +697,39 @@ class ArgumentListFilter:
     def dependencyBinaryCallback(self, flag, arg):
         _logger.debug('dependencyBinaryCallback: %s %s', flag, arg)
         self.isDependencyOnly = True
+        self.dependencyArgPositions.update((len(self.compileArgs), len(self.compileArgs) + 1))
         self.compileArgs.append(flag)
         self.compileArgs.append(arg)
 
+    def includeBinaryCallback(self, flag, arg):
+        _logger.debug('includeBinaryCallback: %s %s', flag, arg)
+        # gcc and clang pick up foo.h.gch or foo.h.pch for -include foo.h
+        for nativePch in (f'{arg}.pch', f'{arg}.gch'):
+            if os.path.exists(nativePch):
+                self.pchUses.append((len(self.compileArgs), 2, arg, nativePch))
+                break
+        self.compileBinaryCallback(flag, arg)
+
+    def includePchBinaryCallback(self, flag, arg):
+        _logger.debug('includePchBinaryCallback: %s %s', flag, arg)
+        self.recordPchUse(len(self.compileArgs), 2, arg)
+        self.compileBinaryCallback(flag, arg)
+
+    def xclangBinaryCallback(self, flag, arg):
+        _logger.debug('xclangBinaryCallback: %s %s', flag, arg)
+        # CMake passes -Xclang -include-pch -Xclang foo.pch
+        start = len(self.compileArgs) - 2
+        if start >= 0 and self.compileArgs[start:] == ['-Xclang', '-include-pch']:
+            self.recordPchUse(start, 4, arg)
+        self.compileBinaryCallback(flag, arg)
+
+    def recordPchUse(self, start, length, nativePch):
+        """ Records the use of a precompiled header, if we can find the header it was built from.
+        """
+        (header, ext) = os.path.splitext(nativePch)
+        if ext in ('.pch', '.gch') and os.path.isfile(header):
+            self.pchUses.append((start, length, header, nativePch))
+
     def compileBinaryCallback(self, flag, arg):
         _logger.debug('compileBinaryCallback: %s %s', flag, arg)
         self.compileArgs.append(flag)
@@ -563,6 +796,64 @@ class ArgumentListFilter:
         _logger.debug('linkingGroupCallback: %s', args)
         self.linkArgs.extend(args)
 
+    def getBitcodeCompileArgs(self, pchFiles=None):
+        """ The compile args without the dependency generation flags.
+
+        The native compile has already written the .d file; the bitcode compile
+        rewriting it is wasted I/O, races under parallel make, and disturbs the
+        timestamps make relies on.
+
+        pchFiles maps headers to precompiled headers built for the bitcode
+        compile; the uses of the native ones are replaced by -include-pch of those.
+        """
+        replacements = {}
+        replaced = set()
+        for (start, length, header, _) in self.pchUses:
+            if pchFiles and pchFiles.get(header):
+                # only one -include-pch per header (CMake passes -include as well).
+                replacements[start] = (length, [] if header in replaced else ['-include-pch', pchFiles[header]])
+                replaced.add(header)
+        return self._editCompileArgs(replacements)
+
+    def getPchBuildArgs(self):
+        """ The bitcode compile args with no -x, and no forced includes, to build a precompiled header from.
+
+        A header forced with -include would be compiled into the PCH, and then
+        included again, out of order, by the translation unit.
+        """
+        replacements = {start: (length, []) for (start, length, _, _) in self.pchUses}
+        args = self._editCompileArgs(replacements)
+        (i, kept) = (0, [])
+        while i < len(args):
+            if args[i] in ('-x', '-include', '-include-pch'):
+                i += 2
+                continue
+            if args[i] == '-Xclang' and args[i + 1:i + 2] in (['-include'], ['-include-pch']):
+                i += 4
+                continue
+            if not args[i].startswith('-x'):
+                kept.append(args[i])
+            i += 1
+        return kept
+
+    def _editCompileArgs(self, replacements):
+        """ compileArgs without the dependency flags, and with the args at the given
+        positions replaced: replacements maps start -> (length, new args).
+        """
+        if not (self.dependencyArgPositions or replacements):
+            return self.compileArgs
+        args = []
+        skip = 0
+        for (i, arg) in enumerate(self.compileArgs):
+            if i in replacements:
+                (skip, new) = replacements[i]
+                args.extend(new)
+            if skip:
+                skip -= 1
+            elif i not in self.dependencyArgPositions:
+                args.append(arg)
+        return args
+
     def getOutputFilename(self):
         if self.outputFilename is not None:
             return self.outputFilename
@@ -575,6 +866,9 @@ class ArgumentListFilter:
 
     def getBitcodeFileName(self):
         (dirs, baseFile) = os.path.split(self.getOutputFilename())
+        artifactDir = getArtifactDir()
+        if artifactDir is not None:
+            return os.path.join(artifactDir, f'{getArtifactKey(self.getOutputFilename())}.{baseFile}.bc')
         bcfilename = os.path.join(dirs, f'.{baseFile}.bc')
         return bcfilename
 
@@ -585,13 +879,26 @@ class ArgumentListFilter:
     def getArtifactNames(self, srcFile, hidden=False):
         (_, srcbase) = os.path.split(srcFile)
         (srcroot, _) = os.path.splitext(srcbase)
+        artifactDir = getArtifactDir()
+        if artifactDir is not None:
+            # the output is part of the key: libtool compiles a source twice, with and without -fPIC.
+            key = getArtifactKey(srcFile, self.getOutputFilename())
+            hiddenbase = os.path.join(artifactDir, f'{key}.{srcroot}.o')
+        else:
+            hiddenbase = f'target/.{srcroot}.o'
         if hidden:
-            objbase = f'target/.{srcroot}.o'
+            objbase = hiddenbase
         else:
-            objbase = f'target/{srcroot}.o'
-        bcbase = f'target/.{srcroot}.o.bc'
+            # not hidden means the compiler itself put the object in the cwd.
+            objbase = f'{srcroot}.o'
+        bcbase = f'{hiddenbase}.bc'
         return [objbase, bcbase]
 
+    def getState(self):
+        """ The recorded fields by name, for logging: instances have __slots__, not a __dict__.
+        """
+        return {slot: getattr(self, slot, None) for cls in type(self).__mro__ for slot in getattr(cls, '__slots__', ())}
+
     #iam: for printing our partitioning of the args
     def dump(self):
         efn = sys.stderr.write
@@ -609,3 +916,4 @@ class ArgumentListFilter:
         efn(f'isCompileOnly = {self.isCompileOnly}\n')
         efn(f'isEmitLLVM = {self.isEmitLLVM}\n')
         efn(f'isStandardIn = {self.isStandardIn}\n')
+        efn(f'isLTO = {self.isLTO}\n')
@@ -24,6 +24,11 @@ This should explain:
 
 in the pip egg, and in the repository.
 
+The bitcode compile passes -pipe, so gcc streams the IR to us on stdin
+rather than writing it to a temporary .s first, and we exec llvm-as in
+our place, handing it that stdin: the (often huge) textual IR never
+touches the disk, and no extra process is spawned.
+
 """
 
 from __future__ import absolute_import
@@ -36,8 +41,6 @@ import os
 
 from .compilers import llvmCompilerPathEnv
 
-from .popenwrapper import Popen
-
 from .arglistfilter import ArgumentListFilter
 
 from .logconfig import logConfig
@@ -49,6 +52,8 @@ _logger = logConfig(__name__)
 class BCFilter(ArgumentListFilter):
     """ Argument filter for the assembler.
     """
+    __slots__ = ('bcName', 'outFileName')
+
     def __init__(self, arglist):
         self.bcName = None
         self.outFileName = None
@@ -85,14 +90,12 @@ def main():
 
     fakeAssembler = [llvmAssembler, infile, '-o', argFilter.outFileName]
 
-    asmProc = Popen(fakeAssembler)
-    realRet = asmProc.wait()
-
-    if realRet != 0:
-        _logger.error('llvm-as failed')
-        sys.exit(realRet)
-
-    sys.exit(realRet)
+    _logger.debug('exec %s', fakeAssembler)
+    try:
+        os.execvp(llvmAssembler, fakeAssembler)
+    except OSError as e:
+        _logger.error('llvm-as failed: %s', str(e))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+""" The thin client side of wllvm-server.
+
+If WLLVM_SERVER_SOCKET names the socket of a running wllvm-server, the wllvm
+entry points hand the whole invocation (argv, cwd, environment, umask, and
+the stdin/stdout/stderr file descriptors) over to the server and just wait
+for the exit code. If there is no server, or it goes away, the caller runs
+the compile in process as usual.
+
+Only the standard library is imported here, the point is to start fast. The
+socket machinery is only imported once we know there is a server to talk to.
+"""
+
+import os
+import struct
+import sys
+
+# Environmental variable naming the unix socket wllvm-server listens on.
+serverSocketEnv = 'WLLVM_SERVER_SOCKET'
+
+# Requests and replies are prefixed with their length, the reply is the exit code.
+_lengthFormat = '!I'
+_exitCodeFormat = '!i'
+
+
+def runOnServer(mode):
+    """ Runs the invocation on the server, returns its exit code or None if there is no server.
+    """
+    socketName = os.getenv(serverSocketEnv)
+    if not socketName:
+        return None
+    import array
+    import json
+    import socket
+
+    mask = os.umask(0)
+    os.umask(mask)
+    request = json.dumps({
+        'mode': mode,
+        'argv': sys.argv,
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+        'umask': mask,
+        'ppid': os.getppid(),
+    }).encode('utf-8')
+    message = struct.pack(_lengthFormat, len(request)) + request
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+            s.connect(socketName)
+            fds = array.array('i', [0, 1, 2])
+            sent = s.sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+            s.sendall(message[sent:])
+            reply = recvAll(s, struct.calcsize(_exitCodeFormat))
+    except OSError:
+        return None
+    if reply is None:
+        return None
+    return struct.unpack(_exitCodeFormat, reply)[0]
+
+
+def recvAll(s, size):
+    """ Reads exactly size bytes from the socket, or returns None if it is closed first.
+    """
+    data = b''
+    while len(data) < size:
+        chunk = s.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def main(mode):
+    """ The body of the wllvm entry points: try the server, then do it ourselves.
+    """
+    rc = runOnServer(mode)
+    if rc is not None:
+        return rc
+    from .compilers import wcompile
+    return wcompile(mode)
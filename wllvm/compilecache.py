@@ -0,0 +1,165 @@
+""" A content addressed cache for the object and bitcode of a compile.
+
+If the environment variable WLLVM_CACHE_DIR points at a directory, single
+source compiles ("... -c foo.c -o foo.o") are looked up there before any
+compiler is run. The key is built from the preprocessed source, the compile
+arguments as split by the ArgumentListFilter, the builder type, and the
+identity of the compilers involved. A hit restores the bitcode file, and the
+object with its bitcode section already attached, so only the preprocessor
+is ever spawned.
+
+The bitcode section records the absolute path of the bitcode file, so that
+path (and the cwd, which ends up in the debug info) are part of the key too.
+In practice this means hits come from rebuilding the same tree in the same
+place, which is exactly what a clean CI build does.
+"""
+
+import os
+
+from subprocess import PIPE, DEVNULL
+
+from .popenwrapper import Popen
+
+from .logconfig import logConfig
+
+# Internal logger
+_logger = logConfig(__name__)
+
+# Environmental variable naming the cache directory.
+cacheDirEnv = 'WLLVM_CACHE_DIR'
+
+# Bump this if the layout of the key or the entries changes.
+cacheVersion = '1'
+
+# compiler path -> identity, saves a stat per compiler per key.
+_compilerIdentities = {}
+
+
+def getCompileCache():
+    """ Returns the cache named by WLLVM_CACHE_DIR, or None if there isn't one.
+    """
+    cacheDir = os.getenv(cacheDirEnv)
+    if not cacheDir:
+        return None
+    return CompileCache(os.path.abspath(cacheDir))
+
+
+def getCompilerIdentity(compiler):
+    """ Identifies a compiler by its resolved path, size and modification time.
+
+    This is the same cheap check ccache uses by default; it avoids spawning
+    the compiler just to ask it for its version.
+    """
+    if compiler in _compilerIdentities:
+        return _compilerIdentities[compiler]
+    import shutil
+    path = shutil.which(compiler)
+    if path is None:
+        identity = compiler
+    else:
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        identity = f'{path}:{st.st_size}:{st.st_mtime_ns}'
+    _compilerIdentities[compiler] = identity
+    return identity
+
+
+class CompileCache:
+    """ The cache directory, entries live in <dir>/<key[:2]>/<key>.{o,bc}.
+    """
+
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+    def getEntryNames(self, key):
+        entryDir = os.path.join(self.cacheDir, key[:2])
+        return (os.path.join(entryDir, f'{key}.o'), os.path.join(entryDir, f'{key}.bc'))
+
+    def getKey(self, builder, af, srcFile, bcFile):
+        """ Hashes everything that determines the object and the bitcode.
+
+        Returns None if the source cannot be preprocessed; the compile will then
+        fail, or succeed, on its own without the cache getting involved.
+        """
+        import hashlib
+        compiler = builder.getCompiler()
+        bitcodeCompiler = builder.getBitcodeCompiler()
+
+        h = hashlib.sha256()
+        def add(field):
+            h.update(field.encode('utf-8'))
+            h.update(b'\0')
+
+        add(cacheVersion)
+        add(type(builder).__name__)
+        add(builder.mode)
+        add(str(builder.isBitcodeFirst()))
+        add(getCompilerIdentity(compiler[0]))
+        add(getCompilerIdentity(bitcodeCompiler[0]))
+        for arg in bitcodeCompiler:
+            add(arg)
+        add('compileArgs')
+        for arg in af.compileArgs:
+            add(arg)
+        add(os.getcwd())
+        add(os.path.abspath(bcFile))
+
+        ppCmd = compiler + af.compileArgs + ['-E', srcFile]
+        ppProc = Popen(ppCmd, stdout=PIPE, stderr=DEVNULL)
+        for chunk in iter(lambda: ppProc.stdout.read(1 << 16), b''):
+            h.update(chunk)
+        ppProc.stdout.close()
+        if ppProc.wait() != 0:
+            _logger.debug('Could not preprocess %s, not using the cache', srcFile)
+            return None
+
+        key = h.hexdigest()
+        _logger.debug('Cache key for %s is %s', srcFile, key)
+        return key
+
+    def restore(self, key, objFile, bcFile):
+        """ Copies a cached pair into place, returns False on a miss.
+
+        Like the entries, the files are renamed into place: the bitcode may be
+        shared with the store, and must not be rewritten where it is.
+        """
+        (cachedObj, cachedBc) = self.getEntryNames(key)
+        if not (os.path.isfile(cachedObj) and os.path.isfile(cachedBc)):
+            _logger.debug('Cache miss for %s', objFile)
+            return False
+        try:
+            # bitcode first, so the object never points at a missing file.
+            copyReplacing(cachedBc, bcFile)
+            copyReplacing(cachedObj, objFile)
+        except OSError as e:
+            _logger.warning('Failed to restore "%s" from the cache: %s', objFile, str(e))
+            return False
+        _logger.info('Cache hit for %s', objFile)
+        return True
+
+    def store(self, key, objFile, bcFile):
+        """ Adds the pair to the cache. Each file is written to a temporary name
+        and renamed into place, so concurrent builds never see a torn entry.
+        """
+        (cachedObj, cachedBc) = self.getEntryNames(key)
+        try:
+            os.makedirs(os.path.dirname(cachedObj), exist_ok=True)
+            copyReplacing(bcFile, cachedBc)
+            copyReplacing(objFile, cachedObj)
+        except OSError as e:
+            _logger.warning('Failed to cache "%s": %s', objFile, str(e))
+
+
+def copyReplacing(src, dst):
+    """ Copies src to a temporary next to dst and renames it over dst.
+    """
+    import shutil
+    import tempfile
+    (fd, tmpName) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)), suffix='.tmp')
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmpName)
+        os.replace(tmpName, dst)
+    except OSError:
+        os.remove(tmpName)
+        raise
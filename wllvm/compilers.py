@@ -4,28 +4,33 @@ from __future__ import print_function
 
 import os
 import sys
-import tempfile
-import hashlib
 import subprocess
 
-from shutil import copyfile
+from contextlib import contextmanager
+
+# hashlib, tempfile, shutil and concurrent.futures are imported where they are
+# used: most invocations (--version, -E, configure probes) never need them, and
+# every wllvm call pays for what is imported here.
 from .filetype import FileType
+from .sections import addElfSection, findElfSection, findMachSection
 from .popenwrapper import Popen
-from .arglistfilter import ArgumentListFilter
+from .arglistfilter import ArgumentListFilter, quoteResponseFileArg
+from .compilecache import getCompileCache
+from .store import storeBitcodeFile
 
 from .logconfig import logConfig
 
 # Internal logger
 _logger = logConfig(__name__)
 
-def wcompile(mode):
+def wcompile(mode, ppid=None):
     """ The workhorse, called from wllvm and wllvm++.
+
+    ppid is the parent of the client process when running under wllvm-server.
     """
 
     # Make sure we are not invoked from ccache
-    parentCmd = subprocess.check_output(
-            ['ps', '-o', 'comm=', '-p', str(os.getppid())], text=True)
-    if parentCmd.strip() == 'ccache':
+    if getParentCommand(ppid or os.getppid()) == 'ccache':
         # The following error message is invisible in terminal
         # when ccache is using its preprocessor mode
         _logger.error('Should not be invoked from ccache')
@@ -48,6 +53,32 @@ def wcompile(mode):
 
         af = builder.getBitcodeArglistFilter()
 
+        # clang puts the bitcode into the object itself, in the one compile.
+        if usesEmbeddedBitcode(builder, af):
+            rc = buildObject(builder, ['-fembed-bitcode'])
+            if rc != 0:
+                _logger.error('Failed to compile using given arguments: [%s]', legible_argstring)
+            return rc
+
+        # the common "... -c foo.c -o foo.o" case.
+        if isSingleSourceCompile(builder, af):
+            return buildSingleSourceCompile(builder, af)
+
+        # compile and link: each object is built once, and we do the final link ourselves.
+        if canCompileAndLinkOnce(builder, af):
+            try:
+                buildAndAttachBitcode(builder, af)
+            except Exception as e:
+                # the bitcode work already failed once, so the native build is all we do.
+                _logger.warning('Falling back to the native compile and link: %s', str(e))
+                removeHiddenArtifacts(af)
+                rc = buildObject(builder)
+                if rc != 0:
+                    _logger.error('Failed to compile using given arguments: [%s]', legible_argstring)
+                else:
+                    _logger.warning('No bitcode is attached to "%s"', af.getOutputFilename())
+                return rc
+
         rc = buildObject(builder)
 
         # phase one compile failed. no point continuing
@@ -59,7 +90,7 @@ def wcompile(mode):
         (skipit, reason) = af.skipBitcodeGeneration()
         if skipit:
             _logger.debug('No work to do: %s', reason)
-            _logger.debug(af.__dict__)
+            _logger.debug(af.getState())
             return rc
 
         # phase two
@@ -88,6 +119,29 @@ RustcPathEnv ='RUSTC_PATH'
 # Environmental variable for cross-compilation target.
 binutilsTargetPrefixEnv = 'BINUTILS_TARGET_PREFIX'
 
+# Environmental variable that asks clang to emit the bitcode first, and then
+# generate the object from it, rather than compiling the source twice.
+bitcodeFirstEnv = 'WLLVM_BITCODE_FIRST'
+
+# Environmental variable that lets the bitcode compile run alongside the native one.
+concurrentBitcodeEnv = 'WLLVM_CONCURRENT_BITCODE'
+
+# Environmental variable that has clang embed the bitcode in the object (-fembed-bitcode),
+# rather than compiling it separately and recording its path.
+embedBitcodeEnv = 'WLLVM_EMBED_BITCODE'
+
+# Environmental variable that has dragonegg preprocess a source once, for both compiles.
+preprocessOnceEnv = 'WLLVM_PREPROCESS_ONCE'
+
+# Sources we preprocess ourselves, and the C++ ones among them.
+preprocessedExtensions = {'.c': '.i', '.cc': '.ii', '.cpp': '.ii', '.cxx': '.ii', '.C': '.ii', '.c++': '.ii'}
+
+# Options that act on the preprocessing, they have no business in the compiles of its output.
+preprocessorOnlyFlags = ('-x', '-include', '-imacros')
+
+# Environmental variable bounding the number of sources we build at once.
+jobsEnv = 'WLLVM_JOBS'
+
 # This is the ELF section name inserted into binaries
 elfSectionName = '.llvm_bc'
 
@@ -104,6 +158,8 @@ darwinSectionName = '__llvm_bc'
 # Same as an ArgumentListFilter, but DO NOT change the name of the output filename when
 # building the bitcode file so that we don't clobber the object file.
 class ClangBitcodeArgumentListFilter(ArgumentListFilter):
+    __slots__ = ()
+
     def __init__(self, arglist):
         localCallbacks = {'-o' : (1, ClangBitcodeArgumentListFilter.outputFileCallback)}
         #super(ClangBitcodeArgumentListFilter, self).__init__(arglist, exactMatches=localCallbacks)
@@ -113,10 +169,23 @@ class ClangBitcodeArgumentListFilter(ArgumentListFilter):
         self.outputFilename = filename
 
 
-def getHashedPathName(path):
-    return hashlib.sha256(path.encode('utf-8')).hexdigest() if path else None
-
 def containsBitcodeSection(outFileName):
+    """ Checks whether the object already has a bitcode section.
+
+    Only the headers are read; objdump is the fallback for formats we do not parse.
+    """
+    try:
+        if sys.platform.startswith('darwin'):
+            found = findMachSection(outFileName, darwinSegmentName, darwinSectionName)
+        else:
+            found = findElfSection(outFileName, elfSectionName)
+        return found is not None
+    except ValueError as e:
+        _logger.debug('Not reading "%s" directly (%s), using objdump', outFileName, str(e))
+    except OSError as e:
+        _logger.error('Error while checking bitcode section in "%s": %s', outFileName, str(e))
+        return False
+
     # Use objdump or readelf to check if the file contains a section named .llvm_bc
     try:
         # Check if the file contains the .llvm_bc section using objdump
@@ -132,9 +201,12 @@ def containsBitcodeSection(outFileName):
 
     return False
 
-def attachBitcodePathToObject(bcPath, outFileName):
+def attachBitcodePathToObject(bcPath, outFileName, strict=False):
     # Don't try to attach a bitcode path to a binary.  Unfortunately
     # that won't work.
+    #
+    # strict is for our own hidden objects: nothing else will produce the
+    # output, so failures raise rather than quietly exiting.
     (_, ext) = os.path.splitext(outFileName)
     _logger.debug('attachBitcodePathToObject: %s  ===> %s [ext = %s]', bcPath, outFileName, ext)
 
@@ -155,10 +227,33 @@ def attachBitcodePathToObject(bcPath, outFileName):
     #    _logger.warning('Cannot attach bitcode path to "%s of type %s"', outFileName, FileType.getReadableFileType(outFileName))
     #    return
 
+    absBcPath = os.path.abspath(bcPath)
+
+    storeBitcodeFile(absBcPath)
+
+    # Unless we are cross compiling, ELF objects get their section written
+    # directly; anything else goes through binutils.
+    if not sys.platform.startswith('darwin') and not os.getenv(binutilsTargetPrefixEnv):
+        try:
+            addElfSection(outFileName, elfSectionName, f'{absBcPath}\n'.encode())
+            _logger.debug('Wrote "%s" into the %s section of "%s"', absBcPath, elfSectionName, outFileName)
+            return
+        except ValueError as e:
+            _logger.debug('Falling back to objcopy for "%s": %s', outFileName, str(e))
+        except OSError:
+            if strict:
+                raise
+            # configure loves to immediately delete things, causing issues for
+            # us here.  Just ignore it
+            sys.exit(0)
+
+    attachBitcodePathWithBinutils(absBcPath, outFileName, strict)
+
+def attachBitcodePathWithBinutils(absBcPath, outFileName, strict=False):
     # Now just build a temporary text file with the full path to the
     # bitcode file that we'll write into the object file.
+    import tempfile
     f = tempfile.NamedTemporaryFile(mode='w+b', delete=False)
-    absBcPath = os.path.abspath(bcPath)
     f.write(absBcPath.encode())
     f.write('\n'.encode())
     _logger.debug('Wrote "%s" to file "%s"', absBcPath, f.name)
@@ -180,27 +275,24 @@ def attachBitcodePathToObject(bcPath, outFileName):
         objcopyCmd = [objcopyBin, '--add-section', f'{elfSectionName}={f.name}', outFileName]
     orc = 0
 
-    # loicg: If the environment variable WLLVM_BC_STORE is set, copy the bitcode
-    # file to that location, using a hash of the original bitcode path as a name
-    storeEnv = os.getenv('WLLVM_BC_STORE')
-    if storeEnv:
-        hashName = getHashedPathName(absBcPath)
-        copyfile(absBcPath, os.path.join(storeEnv, hashName))
-
     try:
         if os.path.getsize(outFileName) > 0:
             objProc = Popen(objcopyCmd)
             orc = objProc.wait()
     except OSError:
+        os.remove(f.name)
+        if strict:
+            raise
         # configure loves to immediately delete things, causing issues for
         # us here.  Just ignore it
-        os.remove(f.name)
         sys.exit(0)
 
     os.remove(f.name)
 
     if orc != 0:
         _logger.error('objcopy failed with %s', orc)
+        if strict:
+            raise Exception(f'objcopy failed with {orc}')
         sys.exit(-1)
 
 class BuilderBase:
@@ -236,6 +328,20 @@ class BuilderBase:
     def getLLVM_ar(self):
         return [f'{self.prefixPath}{os.getenv("LLVM_AR_NAME") or "llvm-ar"}']
 
+    def isBitcodeFirst(self):
+        return False
+
+    def isEmbedBitcode(self):
+        return False
+
+    def isPreprocessOnce(self):
+        return False
+
+    def getBitcodePchFiles(self, srcFile):
+        """ Maps the headers precompiled for the native compile to ones for the bitcode compile.
+        """
+        return {}
+
 class ClangBuilder(BuilderBase):
 
     def getBitcodeGenerationFlags(self):
@@ -250,6 +356,24 @@ class ClangBuilder(BuilderBase):
         cc = self.getCompiler()
         return cc + ['-emit-llvm'] + self.getBitcodeGenerationFlags()
 
+    def isBitcodeFirst(self):
+        # only clang can take its own bitcode as input and carry on from there.
+        # LLVM_BITCODE_GENERATION_FLAGS are for the bitcode alone, they must not shape the object.
+        return bool(os.getenv(bitcodeFirstEnv)) and not self.getBitcodeGenerationFlags()
+
+    def isEmbedBitcode(self):
+        # darwin's linker turns the embedded bitcode into a bundle of its own,
+        # extract-bc only reads the ELF .llvmbc section.
+        return bool(os.getenv(embedBitcodeEnv)) and not sys.platform.startswith('darwin')
+
+    def getBitcodePchFiles(self, srcFile):
+        af = self.getBitcodeArglistFilter()
+        if not af.pchUses:
+            return {}
+        from .pch import getBitcodePchFile
+        return {header: getBitcodePchFile(self, af, header, nativePch, srcFile)
+                for (_, _, header, nativePch) in af.pchUses}
+
     def getCompiler(self):
         if self.mode == "wllvm++":
             env, prog = 'LLVM_CXX_NAME', 'clang++'
@@ -273,10 +397,15 @@ class DragoneggBuilder(BuilderBase):
         # We use '-B' to tell gcc where to look for an assembler.
         # When we build LLVM bitcode we do not want to use the GNU assembler,
         # instead we want gcc to use our own assembler (see as.py).
-        cmd = cc + ['-B', asDir, f'-fplugin={pth}', '-fplugin-arg-dragonegg-emit-ir']
+        # -pipe has gcc stream the IR to it, rather than through a temporary .s.
+        cmd = cc + ['-pipe', '-B', asDir, f'-fplugin={pth}', '-fplugin-arg-dragonegg-emit-ir']
         _logger.debug(cmd)
         return cmd
 
+    def isPreprocessOnce(self):
+        # gcc keeps the original names from the line markers, in diagnostics and debug info.
+        return bool(os.getenv(preprocessOnceEnv))
+
     def getCompiler(self):
         pfx = ''
         if os.getenv('LLVM_GCC_PREFIX') is not None:
@@ -349,14 +478,333 @@ def getBuilder(cmd, mode):
     _logger.critical(errorMsg, compilerEnv, str(compiler))
     raise Exception(errorMsg)
 
-def buildObject(builder):
+# Sub-commands longer than this (in bytes) pass their arguments in a response file.
+responseFileThreshold = 32 * 1024
+
+@contextmanager
+def responseFileCommand(cmd, quoting=True):
+    """ Yields cmd, or cmd[0] @file with the rest of cmd in a response file if cmd is long.
+
+    Our sub-commands repeat the (@file expanded) arguments of the original
+    command, so they can get long enough to hit ARG_MAX, and spawning them
+    means copying the whole argv. rustc reads one argument per line without
+    any quoting, so for it (quoting=False) arguments that would need quoting
+    keep the command as it is.
+    """
+    if sum(len(arg) + 1 for arg in cmd) <= responseFileThreshold:
+        yield cmd
+        return
+    if quoting:
+        lines = [quoteResponseFileArg(arg) for arg in cmd[1:]]
+    elif any('\n' in arg for arg in cmd[1:]):
+        yield cmd
+        return
+    else:
+        lines = cmd[1:]
+    import tempfile
+    with tempfile.NamedTemporaryFile(mode='w', suffix='.rsp', delete=False) as f:
+        f.write('\n'.join(lines))
+        f.write('\n')
+    _logger.debug('Passing the arguments of %s in %s', cmd[0], f.name)
+    try:
+        yield [cmd[0], f'@{f.name}']
+    finally:
+        os.remove(f.name)
+
+def usesGnuResponseFiles(builder):
+    return not isinstance(builder, RustcBuilder)
+
+def buildObject(builder, extraArgs=()):
     objCompiler = builder.getCompiler()
     objCompiler.extend(builder.getCommand())
-    proc = Popen(objCompiler)
-    rc = proc.wait()
+    objCompiler.extend(extraArgs)
+    with responseFileCommand(objCompiler, usesGnuResponseFiles(builder)) as objCompiler:
+        proc = Popen(objCompiler)
+        rc = proc.wait()
     _logger.debug('buildObject rc = %d', rc)
     return rc
 
+def getParentCommand(pid):
+    """ Returns the command name of the process pid.
+
+    Reading /proc/<pid>/comm costs a lot less than spawning ps, which
+    adds up over every compiler call (--version and configure probes included).
+    """
+    try:
+        with open(f'/proc/{pid}/comm') as f:
+            return f.read().strip()
+    except OSError:
+        pass
+    # no procfs, e.g. darwin, where ps reports the full path.
+    parentCmd = subprocess.check_output(['ps', '-o', 'comm=', '-p', str(pid)], text=True)
+    return os.path.basename(parentCmd.strip())
+
+def usesEmbeddedBitcode(builder, af):
+    """ Whether the bitcode is embedded by the native compile, see isEmbedBitcode.
+
+    -flto objects are bitcode already, and clang refuses to embed bitcode in them.
+    Neither will it embed bitcode under some code generation flags, those
+    compiles take the usual two compile path.
+    """
+    if not builder.isEmbedBitcode() or af.isLTO:
+        return False
+    if af.conflictsWithEmbeddedBitcode():
+        _logger.debug('Not embedding bitcode, clang does not allow it with these flags')
+        return False
+    (skipit, _) = af.skipBitcodeGeneration()
+    return not skipit
+
+def isSingleSourceCompile(builder, af):
+    """ Recognizes the "... -c foo.c -o foo.o" case, one C family source to one object.
+    """
+    if isinstance(builder, RustcBuilder):
+        return False
+    (skipit, _) = af.skipBitcodeGeneration()
+    if skipit or not af.isCompileOnly or len(af.inputFiles) != 1:
+        return False
+    return not af.inputFiles[0].endswith(('.bc', '.rs'))
+
+def buildSingleSourceCompile(builder, af):
+    """ Builds and attaches the object and bitcode of a single source compile.
+
+    This is where the optional strategies are picked: a cache hit, bitcode first,
+    preprocessing once, or overlapping the two compiles. Only the native compile
+    generates dependency files; a cache hit would not restore them, with bitcode
+    first there is no native front end run, and preprocessing once would name the
+    temporary, so those are off for commands generating dependencies.
+    """
+    srcFile = af.inputFiles[0]
+    objFile = af.getOutputFilename()
+    bcFile = af.getBitcodeFileName()
+
+    if usesObjectAsBitcode(builder):
+        # with -flto the object is the bitcode, one compile and nothing to attach.
+        rc = buildObject(builder)
+        if rc != 0:
+            _logger.error('Failed to compile using given arguments: [%s]', ' '.join(builder.cmd))
+            return rc
+        with objectStands(objFile, bcFile):
+            if not recordObjectAsBitcode(objFile):
+                makeParentDirs(bcFile)
+                buildBitcodeFile(builder, srcFile, bcFile)
+                attachBitcodePathToObject(bcFile, objFile)
+        return rc
+
+    cache = None
+    cacheKey = None
+    if not af.isDependencyOnly:
+        cache = getCompileCache()
+    if cache is not None:
+        cacheKey = cache.getKey(builder, af, srcFile, bcFile)
+        if cacheKey and cache.restore(cacheKey, objFile, bcFile):
+            with objectStands(objFile):
+                storeBitcodeFile(os.path.abspath(bcFile))
+            return 0
+
+    if builder.isBitcodeFirst() and not af.isDependencyOnly:
+        # bitcode first: one front end run, the object is generated from the bitcode.
+        rc = buildObjectFromBitcode(builder, af)
+    elif canPreprocessOnce(builder, af):
+        # one preprocessing run, both compiles read its output.
+        rc = buildFromPreprocessedSource(builder, af)
+    elif os.getenv(concurrentBitcodeEnv):
+        # run the native and the bitcode compile side by side, joining before the attach.
+        rc = buildObjectAndBitcodeConcurrently(builder, af)
+    else:
+        rc = buildObject(builder)
+        if rc != 0:
+            _logger.error('Failed to compile using given arguments: [%s]', ' '.join(builder.cmd))
+            return rc
+        with objectStands(objFile, bcFile):
+            makeParentDirs(bcFile)
+            buildBitcodeFile(builder, srcFile, bcFile)
+            attachBitcodePathToObject(bcFile, objFile)
+
+    # not when the bitcode is missing, the object would come back without it.
+    if rc == 0 and cacheKey and os.path.exists(bcFile):
+        cache.store(cacheKey, objFile, bcFile)
+    return rc
+
+@contextmanager
+def objectStands(objFile, bcFile=None):
+    """ Runs the bitcode work that follows a successful native compile of objFile.
+
+    The build itself succeeded by then, so a failure there is only a warning,
+    and wllvm still exits with the native compile's code. The bitcode file, if
+    given, is removed: nothing points at it.
+    """
+    try:
+        yield
+    except Exception as e:  # pylint: disable=broad-except
+        _logger.warning('No bitcode attached to "%s": %s', objFile, str(e))
+        if bcFile and os.path.exists(bcFile):
+            os.remove(bcFile)
+
+def usesObjectAsBitcode(builder):
+    """ Whether the objects clang builds are LLVM bitcode already, i.e. it was given -flto.
+    """
+    return isinstance(builder, ClangBuilder) and builder.getBitcodeArglistFilter().isLTO
+
+def recordObjectAsBitcode(objFile):
+    """ Records an -flto object as its own bitcode, returns False if it is not bitcode after all.
+
+    There is no section to attach to a bitcode file; extract-bc takes such
+    objects, and archives of them, as they are. Nothing records their paths,
+    so the store would have no way to look them up, and they are not stored.
+    """
+    if FileType.getFileType(objFile) != FileType.BITCODE:
+        _logger.debug('"%s" is not bitcode despite -flto', objFile)
+        return False
+    _logger.debug('"%s" is its own bitcode', objFile)
+    return True
+
+def getCodegenArgs(compileArgs):
+    """ Drops the front end flags that clang rejects, or misapplies, when its input is bitcode.
+    """
+    codegenArgs = []
+    args = iter(compileArgs)
+    for arg in args:
+        if arg == '-x':
+            next(args, None)
+        elif arg == '-ansi' or arg.startswith(('-std=', '-x')):
+            continue
+        else:
+            codegenArgs.append(arg)
+    return codegenArgs
+
+def getCodegenCommand(builder, af, bcFile, objFile):
+    """ The command lowering the bitcode to the object, with the LLVM passes switched off.
+    """
+    cc = builder.getCompiler()
+    cc.extend(getCodegenArgs(af.compileArgs))
+    cc.extend(['-Qunused-arguments', '-Xclang', '-disable-llvm-passes'])
+    cc.extend(['-c', bcFile, '-o', objFile])
+    return cc
+
+def buildObjectFromBitcode(builder, af):
+    """ Parses the translation unit once: emits the bitcode, then runs codegen only.
+
+    The bitcode has already been through the optimizer with the original flags,
+    so we switch the LLVM passes off and let clang just lower it to an object.
+    """
+    srcFile = af.inputFiles[0]
+    objFile = af.getOutputFilename()
+    bcFile = af.getBitcodeFileName()
+    buildBitcodeFile(builder, srcFile, bcFile)
+
+    cc = getCodegenCommand(builder, af, bcFile, objFile)
+    _logger.debug('buildObjectFromBitcode: %s', cc)
+    with responseFileCommand(cc) as cc:
+        proc = Popen(cc)
+        rc = proc.wait()
+    if rc != 0:
+        _logger.error('Failed to generate object "%s" from bitcode "%s"', objFile, bcFile)
+        return rc
+    with objectStands(objFile, bcFile):
+        attachBitcodePathToObject(bcFile, objFile)
+    return rc
+
+def buildObjectAndBitcodeConcurrently(builder, af):
+    """ Starts the bitcode compile together with the native one and joins both before the attach.
+    """
+    srcFile = af.inputFiles[0]
+    objFile = af.getOutputFilename()
+    bcFile = af.getBitcodeFileName()
+
+    objCompiler = builder.getCompiler()
+    objCompiler.extend(builder.getCommand())
+    bcc = getBitcodeFileCommand(builder, srcFile, bcFile)
+    _logger.debug('buildObjectAndBitcodeConcurrently: %s', bcc)
+    with responseFileCommand(objCompiler) as objCompiler, responseFileCommand(bcc) as bcc:
+        objProc = Popen(objCompiler)
+        try:
+            bcProc = Popen(bcc)
+        except OSError:
+            objProc.wait()
+            raise
+
+        rc = objProc.wait()
+        _logger.debug('buildObject rc = %d', rc)
+        if rc != 0:
+            # no point waiting for bitcode we will never attach
+            bcProc.terminate()
+            bcProc.wait()
+            _logger.error('Failed to compile using given arguments: [%s]', ' '.join(builder.cmd))
+            return rc
+
+        bcrc = bcProc.wait()
+    if bcrc != 0:
+        _logger.warning('Failed to generate bitcode "%s" for "%s"', bcFile, srcFile)
+        sys.exit(bcrc)
+
+    with objectStands(objFile, bcFile):
+        attachBitcodePathToObject(bcFile, objFile)
+    return rc
+
+def canPreprocessOnce(builder, af):
+    """ Whether the single source compile can go through a preprocessed temporary, see isPreprocessOnce.
+
+    The dependency flags would name the temporary, and a forced language or
+    include would be applied a second time to the preprocessed source.
+    """
+    if not builder.isPreprocessOnce() or af.isDependencyOnly:
+        return False
+    if os.path.splitext(af.inputFiles[0])[1] not in preprocessedExtensions:
+        return False
+    return not any(arg in preprocessorOnlyFlags for arg in af.compileArgs)
+
+def buildFromPreprocessedSource(builder, af):
+    """ Preprocesses the source into a temporary .i (or .ii), then builds the object and the bitcode from it.
+    """
+    srcFile = af.inputFiles[0]
+    objFile = af.getOutputFilename()
+    bcFile = af.getBitcodeFileName()
+    suffix = '.ii' if builder.mode == 'wllvm++' else preprocessedExtensions[os.path.splitext(srcFile)[1]]
+
+    import tempfile
+    (fd, ppFile) = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        cpp = builder.getCompiler() + af.compileArgs + ['-E', srcFile, '-o', ppFile]
+        cc = builder.getCompiler() + af.compileArgs + ['-c', ppFile, '-o', objFile]
+        _logger.debug('buildFromPreprocessedSource: %s then %s', cpp, cc)
+        for cmd in (cpp, cc):
+            with responseFileCommand(cmd) as cmd:
+                rc = Popen(cmd).wait()
+            if rc != 0:
+                _logger.error('Failed to compile using given arguments: [%s]', ' '.join(builder.cmd))
+                return rc
+        with objectStands(objFile, bcFile):
+            makeParentDirs(bcFile)
+            buildBitcodeFile(builder, ppFile, bcFile)
+            attachBitcodePathToObject(bcFile, objFile)
+    finally:
+        os.remove(ppFile)
+    return rc
+
+def canCompileAndLinkOnce(builder, af):
+    """ Decides whether a compile and link command can skip the initial native build.
+
+    buildAndAttachBitcode compiles every source into a hidden object and relinks
+    them, overwriting whatever buildObject produced, so for C family sources the
+    first native build is pure overhead. Rust has its own archive dance that needs
+    the real output, and dependency generation wants the original command line.
+    """
+    if isinstance(builder, RustcBuilder):
+        return False
+    (skipit, _) = af.skipBitcodeGeneration()
+    if skipit or af.isCompileOnly or af.isDependencyOnly:
+        return False
+    return not any(srcFile.endswith('.rs') for srcFile in af.inputFiles)
+
+def removeHiddenArtifacts(af):
+    """ Removes the hidden objects and bitcode of a failed buildAndAttachBitcode, some are partial.
+    """
+    for srcFile in af.inputFiles:
+        for path in af.getArtifactNames(srcFile, True):
+            if os.path.exists(path):
+                os.remove(path)
+
 def ArObjectandAttachBitcode(builder):
     extracted_files = []
     objCompiler = builder.getCompiler()
@@ -413,11 +861,15 @@ def buildAndAttachBitcode(builder, af):
         if af.outputFilename is not None:
             objFile = af.outputFilename
             bcFile = af.getBitcodeFileName()
-        buildBitcodeFile(builder, srcFile, bcFile)
-        attachBitcodePathToObject(bcFile, objFile)
+        if not (usesObjectAsBitcode(builder) and recordObjectAsBitcode(objFile)):
+            makeParentDirs(bcFile)
+            buildBitcodeFile(builder, srcFile, bcFile)
+            attachBitcodePathToObject(bcFile, objFile)
 
     else:
 
+        # the per source work is independent until the link, so it is farmed out below.
+        sourceJobs = []
         for srcFile in af.inputFiles:
             _logger.debug('Not compile only case: %s', srcFile)
             (objFile, bcFile) = af.getArtifactNames(srcFile, hidden)
@@ -451,18 +903,10 @@ def buildAndAttachBitcode(builder, af):
                     # newObjectFiles.append(objFile)
             else:
                 if hidden:
-                    _logger.debug('building %s by %s',objFile, srcFile)
-                    buildObjectFile(builder, srcFile, objFile)
                     newObjectFiles.append(objFile)
+                sourceJobs.append((srcFile, objFile, bcFile))
 
-                if srcFile.endswith('.bc'):
-                    _logger.debug('attaching %s to %s', srcFile, objFile)
-                    attachBitcodePathToObject(srcFile, objFile)
-                else:
-                    _logger.debug('building and attaching %s to %s', bcFile, objFile)
-                    buildBitcodeFile(builder, srcFile, bcFile)
-                    attachBitcodePathToObject(bcFile, objFile)
-
+        runSourceJobs(builder, sourceJobs, hidden)
 
     if not af.isCompileOnly and len(newObjectFiles)!= 0:
         _logger.debug("link all files: %s",newObjectFiles)
@@ -470,6 +914,62 @@ def buildAndAttachBitcode(builder, af):
 
     sys.exit(0)
 
+def makeParentDirs(path):
+    dirName = os.path.dirname(path)
+    if dirName:
+        os.makedirs(dirName, exist_ok=True)
+
+def buildAndAttachSource(builder, srcFile, objFile, bcFile, hidden):
+    """ The per source work of buildAndAttachBitcode: object (if hidden), bitcode, attach.
+    """
+    if hidden:
+        _logger.debug('building %s by %s',objFile, srcFile)
+        makeParentDirs(objFile)
+        buildObjectFile(builder, srcFile, objFile)
+
+    if usesObjectAsBitcode(builder) and recordObjectAsBitcode(objFile):
+        return
+
+    if srcFile.endswith('.bc'):
+        _logger.debug('attaching %s to %s', srcFile, objFile)
+        attachBitcodePathToObject(srcFile, objFile, hidden)
+    else:
+        _logger.debug('building and attaching %s to %s', bcFile, objFile)
+        makeParentDirs(bcFile)
+        buildBitcodeFile(builder, srcFile, bcFile)
+        attachBitcodePathToObject(bcFile, objFile, hidden)
+
+def getJobCount(jobs):
+    """ The size of the worker pool: WLLVM_JOBS if set, otherwise one per core.
+    """
+    count = os.getenv(jobsEnv)
+    try:
+        count = int(count) if count else os.cpu_count() or 1
+    except ValueError:
+        _logger.warning('Ignoring %s = "%s", it is not a number', jobsEnv, count)
+        count = os.cpu_count() or 1
+    return max(1, min(count, jobs))
+
+def runSourceJobs(builder, sourceJobs, hidden):
+    """ Runs buildAndAttachSource over the sources on a bounded pool of threads.
+
+    The threads just sit in Popen.wait(), so they are cheap. A failing compile
+    calls sys.exit() in its thread; the SystemExit is re-raised here by result().
+    """
+    workers = getJobCount(len(sourceJobs))
+    if workers <= 1:
+        for (srcFile, objFile, bcFile) in sourceJobs:
+            buildAndAttachSource(builder, srcFile, objFile, bcFile, hidden)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+    _logger.debug('runSourceJobs: %d sources over %d workers', len(sourceJobs), workers)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(buildAndAttachSource, builder, srcFile, objFile, bcFile, hidden)
+                   for (srcFile, objFile, bcFile) in sourceJobs]
+        for future in futures:
+            future.result()
+
 def linkFiles(builder, objectFiles):
     af = builder.getBitcodeArglistFilter()
     outputFile = af.getOutputFilename()
@@ -494,17 +994,18 @@ def linkFiles(builder, objectFiles):
         if '--emit=llvm-bc' in cc:
             cc.remove('--emit=llvm-bc')
         cc.extend(['-o', outputFile])
-    proc = Popen(cc)
-    rc = proc.wait()
+    with responseFileCommand(cc, usesGnuResponseFiles(builder)) as linkCmd:
+        proc = Popen(linkCmd)
+        rc = proc.wait()
     if rc != 0:
         _logger.warning('Failed to link "%s"', str(cc))
         sys.exit(rc)
 
 
-def buildBitcodeFile(builder, srcFile, bcFile):
+def getBitcodeFileCommand(builder, srcFile, bcFile):
     af = builder.getBitcodeArglistFilter()
     bcc = builder.getBitcodeCompiler()
-    bcc.extend(af.compileArgs)
+    bcc.extend(af.getBitcodeCompileArgs(builder.getBitcodePchFiles(srcFile)))
     if srcFile.endswith('.rs'):
         for i, arg in enumerate(bcc):
             if arg.startswith('--emit='):
@@ -517,9 +1018,14 @@ def buildBitcodeFile(builder, srcFile, bcFile):
     else:
         bcc.extend(['-c', srcFile])
     bcc.extend(['-o', bcFile])
+    return bcc
+
+def buildBitcodeFile(builder, srcFile, bcFile):
+    bcc = getBitcodeFileCommand(builder, srcFile, bcFile)
     _logger.debug('buildBitcodeFile: %s', bcc)
-    proc = Popen(bcc)
-    rc = proc.wait()
+    with responseFileCommand(bcc, usesGnuResponseFiles(builder)) as bcc:
+        proc = Popen(bcc)
+        rc = proc.wait()
     if rc != 0:
         _logger.warning('Failed to generate bitcode "%s" for "%s"', bcFile, srcFile)
         sys.exit(rc)
@@ -541,8 +1047,9 @@ def buildObjectFile(builder, srcFile, objFile):
     else:
         cc.extend(['-c', '-o', objFile])
     _logger.debug('buildObjectFile: %s', cc)
-    proc = Popen(cc)
-    rc = proc.wait()
+    with responseFileCommand(cc, usesGnuResponseFiles(builder)) as cc:
+        proc = Popen(cc)
+        rc = proc.wait()
     if rc != 0:
         _logger.warning('Failed to generate object "%s" for "%s"', objFile, srcFile)
         sys.exit(rc)
@@ -565,7 +1072,8 @@ def buildObjectFile(builder, srcFile, objFile):
 #
 #  af.inputFiles is not empty, and compileOnly is false.
 #  in this case the .o's may not exist, we must regenerate
-#  them in any case.
+#  them in any case. Since we then link them ourselves, the
+#  original command is not run at all (see canCompileAndLinkOnce).
 #
 #
 # case 3 (link only)
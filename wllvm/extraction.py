@@ -16,10 +16,12 @@ from .compilers import llvmCompilerPathEnv
 from .compilers import elfSectionName
 from .compilers import darwinSegmentName
 from .compilers import darwinSectionName
-from .compilers import getHashedPathName
+from .store import getHashedPathName, storeEnv, entrySuffixes, getEntryFormat, decompressEntry
 
 from .filetype import FileType
 
+from .sections import findElfSection, findMachSection
+
 from .logconfig import logConfig, informUser
 
 
@@ -57,10 +59,15 @@ binutilsTargetPrefixEnv = 'BINUTILS_TARGET_PREFIX'
 def getSectionSizeAndOffset(sectionName, filename):
     """Returns the size and offset of the section, both in bytes.
 
-    Use objdump on the provided binary; parse out the fields
-    to find the given section.  Parses the output,and
-    extracts thesize and offset of that section (in bytes).
+    ELF files are read directly. For anything else use objdump on
+    the provided binary; parse out the fields to find the given
+    section.  Parses the output,and extracts thesize and offset of
+    that section (in bytes).
     """
+    try:
+        return findElfSection(filename, sectionName)
+    except ValueError as e:
+        _logger.debug('Not reading %s directly (%s), using objdump', filename, str(e))
 
     binUtilsTargetPrefix = os.getenv(binutilsTargetPrefixEnv)
     objdumpBin = f'{binUtilsTargetPrefix}-{"objdump"}' if binUtilsTargetPrefix else 'objdump'
@@ -140,6 +147,30 @@ def convert2octects(otooln):
 def extract_section_darwin(inputFile):
     """Extracts the section as a string, the darwin version.
 
+    Thin Mach-O files are read directly, anything else (fat binaries)
+    goes through otool.
+    """
+    try:
+        val = findMachSection(inputFile, darwinSegmentName, darwinSectionName)
+    except ValueError as e:
+        _logger.debug('Not reading %s directly (%s), using otool', inputFile, str(e))
+        return extract_section_darwin_otool(inputFile)
+    if val is None:
+        _logger.error('%s contained no %s segment', inputFile, darwinSegmentName)
+        return []
+    (sectionSize, sectionOffset) = val
+    contents = [c for c in getSectionContent(sectionSize, sectionOffset, inputFile).splitlines() if c]
+    if not contents:
+        _logger.error('%s contained no %s segment', inputFile, darwinSegmentName)
+    else:
+        # Remove duplicate paths
+        contents = list(set(contents))
+        _logger.debug('Unique bitcode paths: %s', contents)
+    return contents
+
+def extract_section_darwin_otool(inputFile):
+    """Extracts the section as a string, the otool version.
+
     Uses otool to extract the section, then processes it
     to a usable state.
 
@@ -191,10 +222,16 @@ def extract_section_darwin(inputFile):
     return retval
 
 def extract_section_linux(inputFile):
-    """Extracts the section as a string, the *nix version."""
+    """Extracts the section as a string, the *nix version.
+
+    Files without a .llvm_bc section may have their bitcode embedded by clang's
+    -fembed-bitcode; it is written out, and the paths of the modules returned.
+    Where both are present (rlibs, -fembed-bitcode in the user's flags) the
+    .llvm_bc section wins, the modules would only be duplicates.
+    """
     val = getSectionSizeAndOffset(elfSectionName, inputFile)
     if val is None:
-        return []
+        return extractEmbeddedBitcode(inputFile)
     (sectionSize, sectionOffset) = val
     content = getSectionContent(sectionSize, sectionOffset, inputFile)
     contents = content.split('\n')
@@ -223,13 +260,85 @@ def extract_section_linux(inputFile):
     return contents
 
 
+# The section clang's -fembed-bitcode puts the module in; the linker concatenates them.
+embeddedSectionName = '.llvmbc'
+
+# Where embedded modules and decompressed store entries are written out, for the life of the process.
+_scratchDir = None
+
+def getScratchDir():
+    global _scratchDir
+    if _scratchDir is None:
+        import atexit
+        _scratchDir = tempfile.mkdtemp(suffix='wllvm')
+        atexit.register(shutil.rmtree, _scratchDir, True)
+    return _scratchDir
+
+def extractEmbeddedBitcode(inputFile):
+    """Writes the modules of the .llvmbc section of inputFile to files, returns their paths."""
+    try:
+        val = findElfSection(inputFile, embeddedSectionName)
+    except (ValueError, OSError):
+        return []
+    if val is None:
+        return []
+    (sectionSize, sectionOffset) = val
+    with open(inputFile, 'rb') as f:
+        f.seek(sectionOffset)
+        data = f.read(sectionSize)
+
+    scratchDir = getScratchDir()
+    paths = []
+    baseName = os.path.basename(inputFile)
+    for module in splitBitcodeModules(data):
+        (fd, path) = tempfile.mkstemp(dir=scratchDir, suffix=f'.{baseName}.bc')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(module)
+        paths.append(path)
+    _logger.debug('Extracted %d embedded modules from %s', len(paths), inputFile)
+    return paths
+
+def splitBitcodeModules(data):
+    """Splits the concatenation of bitcode modules into the modules.
+
+    A module is the bitcode magic followed by top level blocks (identification,
+    module, strtab, symtab) whose headers give their length in 32 bit words, so
+    we hop from block to block until something other than a block starts.
+    Anything between modules (linker padding) is skipped up to the next magic.
+    """
+    magic = b'BC\xc0\xde'
+    modules = []
+    start = data.find(magic)
+    while start != -1:
+        end = start + len(magic)
+        while end < len(data) and (data[end] & 0x3) == 1:
+            # ENTER_SUBBLOCK in the top level abbreviation width of 2 bits, then
+            # the block id (vbr8), the abbreviation width (vbr4), 32 bit alignment
+            # and the length in words.
+            bit = (end * 8) + 2
+            for width in (8, 4):
+                while True:
+                    chunk = (int.from_bytes(data[bit // 8:bit // 8 + 2], 'little') >> (bit % 8)) & ((1 << width) - 1)
+                    bit += width
+                    if not chunk & (1 << (width - 1)):
+                        break
+            header = start + ((bit - start * 8 + 31) // 32) * 4
+            if header + 4 > len(data):
+                break
+            end = header + 4 + 4 * int.from_bytes(data[header:header + 4], 'little')
+        modules.append(data[start:min(end, len(data))])
+        start = data.find(magic, end)
+    return modules
+
 def getStorePath(bcPath):
-    storeEnv = os.getenv('WLLVM_BC_STORE')
-    if storeEnv:
+    """Returns the store entry of the bitcode, compressed or not, or None."""
+    storeDir = os.getenv(storeEnv)
+    if storeDir:
         hashName = getHashedPathName(bcPath)
-        hashPath = os.path.join(storeEnv, hashName)
-        if os.path.isfile(hashPath):
-            return hashPath
+        for suffix in entrySuffixes:
+            hashPath = os.path.join(storeDir, hashName + suffix)
+            if os.path.isfile(hashPath):
+                return hashPath
     return None
 
 
@@ -238,7 +347,7 @@ def getBitcodePath(bcPath):
 
     First, checks if the given path points to an existing bitcode file.
     If it does not, it tries to look for the bitcode file in the store directory given
-    by the environment variable WLLVM_BC_STORE.
+    by the environment variable WLLVM_BC_STORE, decompressing the entry if need be.
     """
 
     if not bcPath or os.path.isfile(bcPath):
@@ -246,9 +355,27 @@ def getBitcodePath(bcPath):
 
     storePath = getStorePath(bcPath)
     if storePath:
-        return storePath
+        if getEntryFormat(storePath) is None:
+            return storePath
+        # compressed entries are decompressed into the scratch directory
+        bcFile = os.path.join(getScratchDir(), os.path.basename(storePath) + '.bc')
+        if not os.path.isfile(bcFile):
+            _logger.debug('Decompressing %s for %s', storePath, bcPath)
+            decompressEntry(storePath, bcFile)
+        return bcFile
     return bcPath
 
+
+def resolveBitcodePaths(fileNames):
+    """Maps getBitcodePath over the bitcode paths; with a store it runs on a pool
+    of threads, so entries are decompressed in parallel (zlib and lzma release the GIL)."""
+    if not os.getenv(storeEnv) or len(fileNames) < 2:
+        return [getBitcodePath(f) for f in fileNames]
+    from concurrent.futures import ThreadPoolExecutor
+    getScratchDir()
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+        return list(pool.map(getBitcodePath, fileNames))
+
 def executeLinker(linkCmd):
     try:
         # Use blocking call here since the output file needs to be generated
@@ -296,8 +423,7 @@ def linkFiles(pArgs, fileNames):
 
     linkCmd.append(f'-o={pArgs.outputFile}')
 
-    fileNames = map(getBitcodePath, fileNames)
-    fileNames = [x for x in fileNames if x != '']
+    fileNames = [x for x in resolveBitcodePaths(list(fileNames)) if x != '']
 
     # Check the size of the argument string first: If it is larger than the
     # allowed size specified by 'getconf ARG_MAX' we have to link the files
@@ -387,6 +513,20 @@ def handleExecutable(pArgs):
     return linkFiles(pArgs, fileNames)
 
 
+def handleBitcode(pArgs):
+    """ The input is bitcode already, e.g. an object built with -flto.
+    """
+    _logger.info('Input "%s" is bitcode, using it as it is', pArgs.inputFile)
+
+    if pArgs.manifestFlag:
+        writeManifest(f'{pArgs.inputFile}.llvm.manifest', [pArgs.inputFile])
+
+    if pArgs.outputFile is None:
+        pArgs.outputFile = f'{pArgs.inputFile}.{moduleExtension}'
+
+    return linkFiles(pArgs, [pArgs.inputFile])
+
+
 def handleThinArchive(pArgs):
 
     objectPaths = extract_from_thin_archive(pArgs.inputFile)
@@ -397,6 +537,9 @@ def handleThinArchive(pArgs):
     bcFiles = []
     for p in objectPaths:
         _logger.debug('handleThinArchive: processing %s', p)
+        if FileType.getFileType(p) == FileType.BITCODE:
+            bcFiles.append(os.fsdecode(p))
+            continue
         contents = pArgs.extractor(p)
         for c in contents:
             if c:
@@ -457,6 +600,8 @@ def handleArchiveDarwin(pArgs):
     # Make temporary directory to extract objects to
     tempDir = ''
     bitCodeFiles = []
+    # members that are bitcode themselves (-flto) are moved here, out of the way of the cleanup
+    bitcodeDir = tempfile.mkdtemp(suffix='wllvm')
 
     try:
 
@@ -489,7 +634,9 @@ def handleArchiveDarwin(pArgs):
             _logger.debug('Exploring "%s"', root)
             for f in files:
                 fPath = os.path.join(root, f)
-                if FileType.getFileType(fPath) == pArgs.fileType:
+                if FileType.getFileType(fPath) == FileType.BITCODE:
+                    bitCodeFiles.append(keepBitcodeMember(fPath, bitcodeDir, len(bitCodeFiles)))
+                elif FileType.getFileType(fPath) == pArgs.fileType:
 
                     # Extract bitcode locations from object
                     contents = pArgs.extractor(fPath)
@@ -517,7 +664,10 @@ def handleArchiveDarwin(pArgs):
     # Build bitcode archive
     os.chdir(originalDir)
 
-    return buildArchive(pArgs, bitCodeFiles)
+    try:
+        return buildArchive(pArgs, bitCodeFiles)
+    finally:
+        shutil.rmtree(bitcodeDir)
 
 
 
@@ -549,6 +699,8 @@ def handleArchiveLinux(pArgs):
         return 0
 
     bitCodeFiles = []
+    # members that are bitcode themselves (-flto) are moved here, out of the way of the cleanup
+    bitcodeDir = tempfile.mkdtemp(suffix='wllvm')
 
     try:
         tempDir = tempfile.mkdtemp(suffix='wllvm')
@@ -560,6 +712,9 @@ def handleArchiveLinux(pArgs):
 
                 # extact out the ith instance of filename
                 if extractFile(inputFile, filename, i):
+                    if FileType.getFileType(filename) == FileType.BITCODE:
+                        bitCodeFiles.append(keepBitcodeMember(filename, bitcodeDir, len(bitCodeFiles)))
+                        continue
                     # Extract bitcode locations from object
                     contents = pArgs.extractor(filename)
                     # _logger.debug('From instance %s of %s in %s we extracted\n\t%s\n', i, filename, inputFile, contents)
@@ -581,7 +736,22 @@ def handleArchiveLinux(pArgs):
     # Build bitcode archive
     os.chdir(originalDir)
 
-    return buildArchive(pArgs, bitCodeFiles)
+    try:
+        return buildArchive(pArgs, bitCodeFiles)
+    finally:
+        shutil.rmtree(bitcodeDir)
+
+
+def keepBitcodeMember(memberPath, bitcodeDir, index):
+    """ Moves an archive member that is bitcode itself into bitcodeDir, returns its new path.
+
+    Objects built with -flto are bitcode, they carry no section to follow and
+    are used as they are. The index keeps members of the same name apart.
+    """
+    keptPath = os.path.join(bitcodeDir, f'{index}.{os.fsdecode(os.path.basename(memberPath))}')
+    shutil.move(memberPath, keptPath)
+    _logger.debug('Archive member "%s" is bitcode, kept as "%s"', memberPath, keptPath)
+    return keptPath
 
 
 
@@ -745,6 +915,8 @@ def process_file_unix(pArgs):
         retval = handleArchiveLinux(pArgs)
     elif ft == FileType.THIN_ARCHIVE:
         retval = handleThinArchive(pArgs)
+    elif ft == FileType.BITCODE:
+        retval = handleBitcode(pArgs)
     else:
         _logger.error('File "%s" of type %s cannot be used', pArgs.inputFile, FileType.revMap[ft])
     return retval
@@ -766,8 +938,8 @@ def process_file_darwin(pArgs):
     elif ft == FileType.ARCHIVE:
         _logger.info('Handling archive')
         retval = handleArchiveDarwin(pArgs)
-
-
+    elif ft == FileType.BITCODE:
+        retval = handleBitcode(pArgs)
     else:
         _logger.error('File "%s" of type %s cannot be used', pArgs.inputFile, FileType.revMap[ft])
     return retval
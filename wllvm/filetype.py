@@ -1,10 +1,30 @@
 """ A static class that allows the type of a file to be checked.
 """
 import os
+import struct
 
-from subprocess import PIPE
+# ar(1) magic
+_arMagic = b'!<arch>\n'
+_thinArMagic = b'!<thin>\n'
 
-from .popenwrapper import Popen
+# ELF e_type, and the bits of the dynamic section that mark a PIE
+_ET_REL = 1
+_ET_EXEC = 2
+_ET_DYN = 3
+_PT_DYNAMIC = 2
+_DT_NULL = 0
+_DT_FLAGS_1 = 0x6ffffffb
+_DF_1_PIE = 0x08000000
+
+# Mach-O magic (read big endian) and filetype
+_machMagics = {0xfeedface: '>', 0xfeedfacf: '>', 0xcefaedfe: '<', 0xcffaedfe: '<'}
+_fatMagics = {0xcafebabe: False, 0xcafebabf: True}
+_MH_OBJECT = 1
+_MH_EXECUTE = 2
+_MH_DYLIB = 6
+
+# LLVM bitcode, raw or in the wrapper darwin uses (0x0B17C0DE, little endian)
+_bitcodeMagics = (b'BC\xc0\xde', b'\xde\xc0\x17\x0b')
 
 class FileType:
     """ A hack to grok the type of input files.
@@ -20,46 +40,110 @@ class FileType:
     MACH_SHARED = None
     ARCHIVE = None
     THIN_ARCHIVE = None
+    BITCODE = None
 
 
     # Provides int -> str map
     revMap = {}
 
+    # (st_dev, st_ino, st_mtime_ns, st_size) -> file type, for the life of the process.
+    typeCache = {}
+
     @classmethod
     def getFileType(cls, fileName):
         """ Returns the type of a file.
 
-        This is a hacky way of determining
-        the type of file we are looking at.
-        Maybe we should use python-magic instead?
+        We used to ask file(1), and grep its English. Now we look at the
+        magic numbers ourselves: the ar magic, the ELF e_type, the Mach-O
+        filetype, and the bitcode magic. Answers are memoized on the identity
+        of the file, so asking again after the file has been rewritten gives a
+        fresh answer.
         """
-        retval = None
-        fileP = Popen(['file', os.path.realpath(fileName)], stdout=PIPE)
-        output = fileP.communicate()[0]
-        foutput = output.decode()
-        foutput = foutput.split(' ', 1)[1] # Strip file path
-
-        if 'ELF' in foutput and 'executable' in foutput:
-            retval = cls.ELF_EXECUTABLE
-        elif 'Mach-O' in foutput and 'executable' in foutput:
-            retval = cls.MACH_EXECUTABLE
-        elif 'ELF' in foutput and 'shared' in foutput:
-            retval = cls.ELF_SHARED
-        elif 'Mach-O' in foutput and 'dynamically linked shared' in foutput:
-            retval = cls.MACH_SHARED
-        elif 'current ar archive' in foutput:
-            retval = cls.ARCHIVE
-        elif 'thin archive' in foutput:
-            retval = cls.THIN_ARCHIVE
-        elif 'ELF' in foutput and 'relocatable' in foutput:
-            retval = cls.ELF_OBJECT
-        elif 'Mach-O' in foutput and 'object' in foutput:
-            retval = cls.MACH_OBJECT
-        else:
-            retval = cls.UNKNOWN
-
+        try:
+            st = os.stat(fileName)
+        except OSError:
+            return cls.UNKNOWN
+        key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+        retval = cls.typeCache.get(key)
+        if retval is None:
+            try:
+                with open(fileName, 'rb') as f:
+                    retval = cls.readFileType(f)
+            except (OSError, struct.error):
+                retval = cls.UNKNOWN
+            cls.typeCache[key] = retval
         return retval
 
+    @classmethod
+    def readFileType(cls, f, offset=0):
+        f.seek(offset)
+        header = f.read(64)
+        if header.startswith(_arMagic):
+            return cls.ARCHIVE
+        if header.startswith(_thinArMagic):
+            return cls.THIN_ARCHIVE
+        if header.startswith(b'\x7fELF'):
+            return cls.readElfType(f, header)
+        if header.startswith(_bitcodeMagics):
+            return cls.BITCODE
+        if len(header) >= 16:
+            (magic,) = struct.unpack('>I', header[:4])
+            if magic in _machMagics:
+                (filetype,) = struct.unpack(_machMagics[magic] + 'I', header[12:16])
+                return {_MH_OBJECT: cls.MACH_OBJECT,
+                        _MH_EXECUTE: cls.MACH_EXECUTABLE,
+                        _MH_DYLIB: cls.MACH_SHARED}.get(filetype, cls.UNKNOWN)
+            if magic in _fatMagics and offset == 0:
+                # a universal binary, like file(1) we go by the first architecture.
+                # Java class files share the magic, but have a large version number here.
+                (nfat,) = struct.unpack('>I', header[4:8])
+                if 0 < nfat < 20:
+                    if _fatMagics[magic]:
+                        (archOffset,) = struct.unpack('>Q', header[16:24])
+                    else:
+                        (archOffset,) = struct.unpack('>I', header[16:20])
+                    return cls.readFileType(f, archOffset)
+        return cls.UNKNOWN
+
+    @classmethod
+    def readElfType(cls, f, header):
+        order = {1: '<', 2: '>'}.get(header[5])
+        is64 = header[4] == 2
+        if order is None or len(header) < (64 if is64 else 52):
+            return cls.UNKNOWN
+        (e_type,) = struct.unpack(order + 'H', header[16:18])
+        if e_type == _ET_REL:
+            return cls.ELF_OBJECT
+        if e_type == _ET_EXEC:
+            return cls.ELF_EXECUTABLE
+        if e_type != _ET_DYN:
+            return cls.UNKNOWN
+        # position independent executables are ET_DYN too; like file(1) we
+        # tell them apart from shared libraries by the DF_1_PIE flag.
+        if is64:
+            (e_phoff,) = struct.unpack(order + 'Q', header[32:40])
+            (e_phentsize, e_phnum) = struct.unpack(order + 'HH', header[54:58])
+            phdr, dyn = order + 'IIQQQQQQ', order + 'qQ'
+        else:
+            (e_phoff,) = struct.unpack(order + 'I', header[28:32])
+            (e_phentsize, e_phnum) = struct.unpack(order + 'HH', header[42:46])
+            phdr, dyn = order + 'IIIIIIII', order + 'iI'
+        f.seek(e_phoff)
+        for _ in range(e_phnum):
+            entry = struct.unpack(phdr, f.read(e_phentsize)[:struct.calcsize(phdr)])
+            if entry[0] != _PT_DYNAMIC:
+                continue
+            # the offset and size of the segment sit in different slots for the two classes
+            (p_offset, p_filesz) = (entry[2], entry[5]) if is64 else (entry[1], entry[4])
+            f.seek(p_offset)
+            for (tag, val) in struct.iter_unpack(dyn, f.read(p_filesz - p_filesz % struct.calcsize(dyn))):
+                if tag == _DT_NULL:
+                    break
+                if tag == _DT_FLAGS_1:
+                    return cls.ELF_EXECUTABLE if val & _DF_1_PIE else cls.ELF_SHARED
+            break
+        return cls.ELF_SHARED
+
 
     @classmethod
     def getFileTypeString(cls, fti):
@@ -82,7 +166,8 @@ class FileType:
                                         'MACH_OBJECT',
                                         'MACH_SHARED',
                                         'ARCHIVE',
-                                        'THIN_ARCHIVE')):
+                                        'THIN_ARCHIVE',
+                                        'BITCODE')):
             setattr(cls, name, index)
             cls.revMap[index] = name
 
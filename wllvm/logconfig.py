@@ -15,14 +15,20 @@ _loggingDestination = 'WLLVM_OUTPUT_FILE'
 
 _validLogLevels = ['ERROR', 'WARNING', 'INFO', 'DEBUG']
 
+# Whether the root logger has been configured, every module calls logConfig at import.
+_rootConfigured = False
+
 def logConfig(name):
+    global _rootConfigured
 
-    destination = os.getenv(_loggingDestination)
+    if not _rootConfigured:
+        destination = os.getenv(_loggingDestination)
 
-    if destination:
-        logging.basicConfig(filename=destination, level=logging.WARNING, format='%(levelname)s:%(message)s')
-    else:
-        logging.basicConfig(level=logging.WARNING, format='%(levelname)s:%(message)s')
+        if destination:
+            logging.basicConfig(filename=destination, level=logging.WARNING, format='%(levelname)s:%(message)s')
+        else:
+            logging.basicConfig(level=logging.WARNING, format='%(levelname)s:%(message)s')
+        _rootConfigured = True
 
     retval = logging.getLogger(name)
 
@@ -46,6 +52,22 @@ def logConfig(name):
 
     return retval
 
+def resetLogging():
+    """ Reapplies the logging configuration from the (new) environment.
+
+    Used by the forked children of wllvm-server, whose loggers were configured
+    from the server's environment.
+    """
+    global _rootConfigured
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    _rootConfigured = False
+    for name in list(logging.root.manager.loggerDict):
+        if name.split('.')[0] == 'wllvm':
+            logging.getLogger(name).setLevel(logging.NOTSET)
+            logConfig(name)
+
 def loggingConfiguration():
     destination = os.getenv(_loggingDestination)
     level = os.getenv(_loggingEnvLevel_new)
@@ -0,0 +1,123 @@
+""" Precompiled headers for the bitcode compile.
+
+A command that uses a precompiled header (-include foo.h with a foo.h.gch or
+foo.h.pch next to it, -include-pch foo.h.pch, or CMake's -Xclang -include-pch)
+gets the header parsed once by the native compile, but the bitcode compile
+cannot safely reuse that PCH: it may have been built by gcc, or with flags the
+bitcode compiler does not share. Parsing the full header again dominates the
+bitcode compile of a typical C++ translation unit.
+
+So we build a second PCH, with the bitcode compiler and the flags of the
+bitcode compile, and keep it next to the native one as
+.<header>.<key>.bc.pch. The key covers the compiler, the flags, the header and
+the native PCH (which the build system rebuilds whenever anything the header
+includes changes), so every translation unit sharing a header and flag set
+shares one bitcode PCH. A lock makes sure parallel compiles build it only once,
+and is removed once the PCH is in place. If no lock can be taken, e.g. on a
+read only directory, the bitcode compile does without a PCH.
+"""
+
+import os
+
+from .popenwrapper import Popen
+from .compilecache import getCompilerIdentity
+
+from .logconfig import logConfig
+
+# Internal logger
+_logger = logConfig(__name__)
+
+# Bump this if the key changes.
+pchVersion = '1'
+
+# Sources that make a C++ header of the precompiled header.
+cxxSourceExtensions = ('.cc', '.cpp', '.cxx', '.C', '.c++', '.ii')
+
+
+def getBitcodePchFile(builder, af, header, nativePch, srcFile):
+    """ Returns a PCH of header for the bitcode compile of srcFile, building it if need be.
+
+    Returns None if it cannot be built, the bitcode compile then uses the original flags.
+    """
+    import hashlib
+
+    # The bitcode compiler minus -emit-llvm, which has no business in a PCH build.
+    pchCompiler = [arg for arg in builder.getBitcodeCompiler() if arg != '-emit-llvm']
+    pchArgs = af.getPchBuildArgs()
+    if builder.mode == 'wllvm++' or srcFile.endswith(cxxSourceExtensions):
+        language = 'c++-header'
+    else:
+        language = 'c-header'
+
+    try:
+        stats = [os.stat(header), os.stat(nativePch)]
+    except OSError as e:
+        _logger.warning('Not using a precompiled header for "%s": %s', header, str(e))
+        return None
+    h = hashlib.sha256()
+    fields = [pchVersion, getCompilerIdentity(pchCompiler[0])] + pchCompiler + pchArgs
+    fields += [language, os.path.abspath(header)] + [f'{st.st_mtime_ns}:{st.st_size}' for st in stats]
+    for field in fields:
+        h.update(field.encode('utf-8'))
+        h.update(b'\0')
+    key = h.hexdigest()[:16]
+
+    pchDir = os.path.dirname(os.path.abspath(nativePch))
+    pchFile = os.path.join(pchDir, f'.{os.path.basename(header)}.{key}.bc.pch')
+    if os.path.exists(pchFile):
+        return pchFile
+
+    import fcntl
+    lockName = f'{pchFile}.lock'
+    try:
+        lock = open(lockName, 'w')
+    except OSError as e:
+        _logger.warning('Not using a precompiled header for "%s": %s', header, str(e))
+        return None
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        except OSError as e:
+            _logger.warning('Not using a precompiled header for "%s": %s', header, str(e))
+            return None
+        try:
+            # someone else may have built it while we waited.
+            if os.path.exists(pchFile):
+                return pchFile
+            return buildBitcodePchFile(pchCompiler + pchArgs + ['-x', language, header], header, pchFile)
+        finally:
+            removeLock(lock, lockName)
+
+
+def removeLock(lock, lockName):
+    """ Removes the lock file we hold, unless it has been replaced already.
+
+    Whoever waits on it finds the PCH once they hold it, and newcomers find the
+    PCH before they look for the lock.
+    """
+    try:
+        if os.path.samestat(os.fstat(lock.fileno()), os.stat(lockName)):
+            os.remove(lockName)
+    except OSError:
+        pass
+
+
+def buildBitcodePchFile(cmd, header, pchFile):
+    """ Runs cmd, which builds the PCH of header, into a temporary and renames it to pchFile.
+    """
+    import tempfile
+    try:
+        (fd, tmpFile) = tempfile.mkstemp(dir=os.path.dirname(pchFile), suffix='.tmp')
+        os.close(fd)
+    except OSError as e:
+        _logger.warning('Not using a precompiled header for "%s": %s', header, str(e))
+        return None
+    cmd = cmd + ['-o', tmpFile]
+    _logger.debug('getBitcodePchFile: %s', cmd)
+    rc = Popen(cmd).wait()
+    if rc != 0:
+        _logger.warning('Failed to build a bitcode precompiled header for "%s"', header)
+        os.remove(tmpFile)
+        return None
+    os.replace(tmpFile, pchFile)
+    return pchFile
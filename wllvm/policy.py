@@ -0,0 +1,100 @@
+""" A policy deciding which compiles get bitcode.
+
+If the environment variable WLLVM_POLICY names a file, each of its lines is a
+rule of the form
+
+    include|exclude  source|output|flag  <glob>
+
+for instance
+
+    # no bitcode for generated code, vendored trees or tests
+    exclude source *.pb.cc
+    exclude source */third_party/*
+    include source */third_party/ours/*
+    exclude output *_test
+    exclude flag -DTESTING*
+
+Globs are matched with fnmatch, so * also matches across slashes. Source and
+output rules are tried on both the path as given and its absolute form. A
+flag rule matches if any of the compile or link flags does. The rules are
+checked in order and the last one that matches a source decides. A compile
+skips its bitcode when every one of its sources is excluded.
+"""
+
+import os
+import fnmatch
+
+from .logconfig import logConfig
+
+# Internal logger
+_logger = logConfig(__name__)
+
+# Environmental variable naming the policy file.
+policyEnv = 'WLLVM_POLICY'
+
+_actions = ('include', 'exclude')
+_kinds = ('source', 'output', 'flag')
+
+# policy file name -> Policy, it is read once per process.
+_policies = {}
+
+
+def getPolicy():
+    """ Returns the policy named by WLLVM_POLICY, or None if there isn't one.
+    """
+    policyFile = os.getenv(policyEnv)
+    if not policyFile:
+        return None
+    if policyFile not in _policies:
+        _policies[policyFile] = Policy.fromFile(policyFile)
+    return _policies[policyFile]
+
+
+class Policy:
+    """ An ordered list of (exclude, kind, glob) rules.
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    @staticmethod
+    def fromFile(policyFile):
+        rules = []
+        try:
+            with open(policyFile) as f:
+                lines = f.readlines()
+        except OSError as e:
+            _logger.warning('Could not read the policy file "%s": %s', policyFile, str(e))
+            return Policy(rules)
+        for (lineno, line) in enumerate(lines, 1):
+            fields = line.split(None, 2)
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) != 3 or fields[0] not in _actions or fields[1] not in _kinds:
+                _logger.warning('%s:%d: ignoring malformed rule "%s"', policyFile, lineno, line.strip())
+                continue
+            rules.append((fields[0] == 'exclude', fields[1], fields[2].strip()))
+        return Policy(rules)
+
+    def isExcluded(self, source, output, flags):
+        """ Whether the source, compiled to output with flags, should go without bitcode.
+        """
+        paths = {'source': pathForms(source), 'output': pathForms(output) if output else [], 'flag': flags}
+        excluded = False
+        for (exclude, kind, glob) in self.rules:
+            if any(fnmatch.fnmatchcase(candidate, glob) for candidate in paths[kind]):
+                excluded = exclude
+        return excluded
+
+    def excludes(self, af):
+        """ Whether every source of the command is excluded.
+        """
+        if not self.rules or not af.inputFiles:
+            return False
+        flags = af.compileArgs + af.linkArgs
+        output = af.getOutputFilename()
+        return all(self.isExcluded(source, output, flags) for source in af.inputFiles)
+
+
+def pathForms(path):
+    return [path, os.path.abspath(path)]
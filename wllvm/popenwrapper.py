@@ -1,6 +1,5 @@
 import os
 import subprocess
-import pprint
 import logging
 
 # This module provides a wrapper for subprocess.POpen
@@ -10,9 +9,13 @@ import logging
 _logger = logging.getLogger(__name__)
 
 def Popen(*pargs, **kwargs):
-    _logger.debug("WLLVM Executing:\n" + pprint.pformat(pargs[0]) + "\nin: " +  os.getcwd())
+    # pprint is only imported when it is needed, it costs more than the rest of this module.
+    if _logger.isEnabledFor(logging.DEBUG):
+        import pprint
+        _logger.debug("WLLVM Executing:\n" + pprint.pformat(pargs[0]) + "\nin: " +  os.getcwd())
     try:
         return subprocess.Popen(*pargs, **kwargs)
     except OSError:
+        import pprint
         _logger.error("WLLVM Failed to execute: %s", pprint.pformat(pargs[0]))
         raise
@@ -0,0 +1,248 @@
+""" Reading and writing object file sections without binutils.
+
+Finding a section only takes a look at the headers, which is much cheaper than
+running objdump (or otool) over the file and searching its output.
+
+Attaching the bitcode path to an object used to cost a temporary file, an
+fsync, and a spawned objcopy for every single compile. For the ELF objects
+we see on Linux and FreeBSD, adding a section is simple enough to do here:
+
+  1. the section contents are appended to the end of the file,
+  2. followed by a copy of the section name string table with the new name added,
+  3. followed by a copy of the section header table with the new section added,
+  4. finally the ELF header is pointed at the new section header table.
+
+The old string table and section header table are left behind as unreferenced
+bytes. Since the ELF header is rewritten last, an interrupted attach leaves the
+object exactly as it was, apart from some trailing junk.
+"""
+
+import struct
+
+# ELF identification
+ELFMAG = b'\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+# e_type
+ET_REL = 1
+
+# sh_type
+SHT_PROGBITS = 1
+
+# special section indices
+SHN_UNDEF = 0
+SHN_LORESERVE = 0xff00
+SHN_XINDEX = 0xffff
+
+# The parts of the ELF header after e_ident, and a section header, per class.
+_elfHeaderFormats = {
+    ELFCLASS32: 'HHIIIIIHHHHHH',
+    ELFCLASS64: 'HHIQQQIHHHHHH',
+}
+_sectionHeaderFormats = {
+    ELFCLASS32: 'IIIIIIIIII',
+    ELFCLASS64: 'IIQQQQIIQQ',
+}
+_byteOrders = {ELFDATA2LSB: '<', ELFDATA2MSB: '>'}
+
+# Indices into the unpacked ELF header (after e_ident).
+_E_TYPE = 0
+_E_SHOFF = 5
+_E_SHENTSIZE = 10
+_E_SHNUM = 11
+_E_SHSTRNDX = 12
+
+# Indices into an unpacked section header.
+_SH_NAME = 0
+_SH_OFFSET = 4
+_SH_SIZE = 5
+_SH_LINK = 6
+
+
+class ElfFile:
+    """ The header and section header table of an ELF file.
+
+    Raises ValueError if the file is not an ELF file we understand.
+    """
+
+    def __init__(self, f):
+        ident = f.read(16)
+        if len(ident) < 16 or ident[:4] != ELFMAG:
+            raise ValueError('not an ELF file')
+        self.elfClass = ident[4]
+        if self.elfClass not in _elfHeaderFormats or ident[5] not in _byteOrders:
+            raise ValueError('unsupported ELF class or byte order')
+        order = _byteOrders[ident[5]]
+        self.ident = ident
+        self.headerFormat = order + _elfHeaderFormats[self.elfClass]
+        self.sectionFormat = order + _sectionHeaderFormats[self.elfClass]
+        self.sectionSize = struct.calcsize(self.sectionFormat)
+
+        raw = f.read(struct.calcsize(self.headerFormat))
+        if len(raw) < struct.calcsize(self.headerFormat):
+            raise ValueError('truncated ELF header')
+        self.header = list(struct.unpack(self.headerFormat, raw))
+
+        self.sections = []
+        shoff = self.header[_E_SHOFF]
+        if shoff == 0:
+            return
+        if self.header[_E_SHENTSIZE] != self.sectionSize:
+            raise ValueError('unexpected section header size')
+        f.seek(shoff)
+        first = f.read(self.sectionSize)
+        if len(first) < self.sectionSize:
+            raise ValueError('truncated section header table')
+        sh0 = list(struct.unpack(self.sectionFormat, first))
+        # with more than SHN_LORESERVE sections the real count lives in section 0
+        count = self.header[_E_SHNUM] or sh0[_SH_SIZE]
+        if count == 0:
+            return
+        rest = f.read(self.sectionSize * (count - 1))
+        if len(rest) < self.sectionSize * (count - 1):
+            raise ValueError('truncated section header table')
+        self.sections = [sh0] + [list(s) for s in struct.iter_unpack(self.sectionFormat, rest)]
+
+    def getShstrndx(self):
+        shstrndx = self.header[_E_SHSTRNDX]
+        if shstrndx == SHN_XINDEX:
+            shstrndx = self.sections[0][_SH_LINK]
+        return shstrndx
+
+    def readSection(self, f, index):
+        section = self.sections[index]
+        f.seek(section[_SH_OFFSET])
+        return f.read(section[_SH_SIZE])
+
+
+def addElfSection(fileName, sectionName, data):
+    """ Appends a (non allocated, PROGBITS) section to an ELF relocatable object in place.
+
+    This is the moral equivalent of objcopy --add-section sectionName=file. The
+    linker concatenates such sections, which is what lets us find every
+    bitcode file in the final executable.
+    """
+    with open(fileName, 'r+b') as f:
+        elf = ElfFile(f)
+        if elf.header[_E_TYPE] != ET_REL:
+            raise ValueError('not a relocatable ELF object')
+        if not elf.sections:
+            raise ValueError('ELF object without a section header table')
+        shstrndx = elf.getShstrndx()
+        if shstrndx == SHN_UNDEF or shstrndx >= len(elf.sections):
+            raise ValueError('ELF object without a section name table')
+        shstrtab = elf.readSection(f, shstrndx)
+
+        f.seek(0, 2)
+        end = f.tell()
+
+        # 1. the contents
+        dataOffset = end
+        f.write(data)
+        end += len(data)
+
+        # 2. the names, old and new
+        nameOffset = len(shstrtab)
+        shstrtab += sectionName.encode('utf-8') + b'\0'
+        f.write(shstrtab)
+        elf.sections[shstrndx][_SH_OFFSET] = end
+        elf.sections[shstrndx][_SH_SIZE] = len(shstrtab)
+        end += len(shstrtab)
+
+        # 3. the section header table, suitably aligned
+        align = 8 if elf.elfClass == ELFCLASS64 else 4
+        padding = -end % align
+        f.write(b'\0' * padding)
+        end += padding
+        elf.sections.append([nameOffset, SHT_PROGBITS, 0, 0, dataOffset, len(data), 0, 0, 1, 0])
+        count = len(elf.sections)
+        if count >= SHN_LORESERVE:
+            elf.sections[0][_SH_SIZE] = count
+            elf.header[_E_SHNUM] = 0
+        else:
+            elf.header[_E_SHNUM] = count
+        f.write(b''.join(struct.pack(elf.sectionFormat, *s) for s in elf.sections))
+        elf.header[_E_SHOFF] = end
+
+        # 4. commit
+        f.seek(16)
+        f.write(struct.pack(elf.headerFormat, *elf.header))
+
+
+def findElfSection(fileName, sectionName):
+    """ Returns the (size, offset) of the named section of an ELF file, or None.
+
+    Only the ELF header, the section header table and the section name table
+    are read. Raises ValueError if the file is not an ELF file.
+    """
+    with open(fileName, 'rb') as f:
+        elf = ElfFile(f)
+        if not elf.sections:
+            return None
+        shstrndx = elf.getShstrndx()
+        if shstrndx == SHN_UNDEF or shstrndx >= len(elf.sections):
+            return None
+        names = elf.readSection(f, shstrndx)
+        wanted = sectionName.encode('utf-8')
+        for section in elf.sections:
+            start = section[_SH_NAME]
+            end = names.find(b'\0', start)
+            if names[start:end] == wanted:
+                return (section[_SH_SIZE], section[_SH_OFFSET])
+    return None
+
+
+# Mach-O magic (read big endian) -> (byte order, 64 bit)
+_machMagics = {
+    0xfeedface: ('>', False),
+    0xfeedfacf: ('>', True),
+    0xcefaedfe: ('<', False),
+    0xcffaedfe: ('<', True),
+}
+LC_SEGMENT = 0x1
+LC_SEGMENT_64 = 0x19
+
+
+def findMachSection(fileName, segmentName, sectionName):
+    """ Returns the (size, offset) of the named section of a (thin) Mach-O file, or None.
+
+    Only the load commands are read. In objects all the sections live in one
+    anonymous segment, so it is the segment name recorded in the section
+    itself that we go by. Raises ValueError if the file is not a thin Mach-O file.
+    """
+    with open(fileName, 'rb') as f:
+        header = f.read(32)
+        if len(header) < 32:
+            raise ValueError('not a Mach-O file')
+        (magic,) = struct.unpack('>I', header[:4])
+        if magic not in _machMagics:
+            raise ValueError('not a Mach-O file')
+        (order, is64) = _machMagics[magic]
+        (ncmds, sizeofcmds) = struct.unpack(order + 'II', header[16:24])
+        f.seek(32 if is64 else 28)
+        commands = f.read(sizeofcmds)
+
+    if is64:
+        (segCmd, segFormat, sectFormat) = (LC_SEGMENT_64, order + '16sQQQQiiII', order + '16s16sQQIIIIIIII')
+    else:
+        (segCmd, segFormat, sectFormat) = (LC_SEGMENT, order + '16sIIIIiiII', order + '16s16sIIIIIIIII')
+    segSize = struct.calcsize(segFormat)
+    sectSize = struct.calcsize(sectFormat)
+    wanted = (segmentName.encode('utf-8'), sectionName.encode('utf-8'))
+
+    pos = 0
+    for _ in range(ncmds):
+        (cmd, cmdsize) = struct.unpack_from(order + 'II', commands, pos)
+        if cmdsize < 8 or pos + cmdsize > len(commands):
+            raise ValueError('malformed Mach-O load commands')
+        if cmd == segCmd:
+            nsects = struct.unpack_from(segFormat, commands, pos + 8)[7]
+            for i in range(nsects):
+                section = struct.unpack_from(sectFormat, commands, pos + 8 + segSize + i * sectSize)
+                if (section[1].rstrip(b'\0'), section[0].rstrip(b'\0')) == wanted:
+                    return (section[3], section[4])
+        pos += cmdsize
+    return None
@@ -0,0 +1,177 @@
+""" wllvm-server: runs wllvm invocations for the thin client in client.py.
+
+A build with tens of thousands of compiler calls spends a good deal of its
+wllvm time starting interpreters and importing the same modules. The server
+does that once: it imports the compile machinery and builds the argument
+tables up front, listens on a unix
+socket, and forks a child per request. The child takes over the client's
+stdin, stdout and stderr, its cwd, environment and umask, runs wcompile, and
+sends the exit code back. Forking keeps requests isolated from each other
+(wcompile chdirs, exits, and reads the environment freely) while every child
+starts from the warm parent.
+
+Usage:
+
+    wllvm-server /tmp/wllvm.sock &
+    export WLLVM_SERVER_SOCKET=/tmp/wllvm.sock
+"""
+
+import argparse
+import array
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+
+from .arglistfilter import ArgumentListFilter
+from .client import serverSocketEnv, recvAll, _lengthFormat, _exitCodeFormat
+from .compilers import wcompile, ClangBitcodeArgumentListFilter
+
+from .logconfig import logConfig, resetLogging
+
+# Internal logger
+_logger = logConfig(__name__)
+
+
+def warmUp():
+    """ Does the work every child would otherwise repeat: building the argument
+    tables, and the imports the compile path only makes when it gets there.
+    """
+    # pylint: disable=import-outside-toplevel,unused-import
+    import fcntl
+    import hashlib
+    import shutil
+    import tempfile
+    from concurrent.futures import ThreadPoolExecutor
+    from . import pch
+    for filterClass in (ArgumentListFilter, ClangBitcodeArgumentListFilter):
+        filterClass(['-c', 'warm.c', '-o', 'warm.o'])
+
+
+def removeSocket(socketName):
+    """ Removes socketName if it is a socket, and leaves anything else alone.
+    """
+    try:
+        if stat.S_ISSOCK(os.lstat(socketName).st_mode):
+            os.unlink(socketName)
+    except FileNotFoundError:
+        pass
+
+
+def serve(socketName):
+    """ Accepts requests until killed.
+    """
+    warmUp()
+    removeSocket(socketName)
+    if os.path.lexists(socketName):
+        sys.exit(f'wllvm-server: "{socketName}" exists and is not a socket')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # whoever can connect can run commands as us, so the socket is never
+    # accessible to others, not even between the bind and a chmod.
+    mask = os.umask(0o077)
+    try:
+        server.bind(socketName)
+    finally:
+        os.umask(mask)
+    server.listen(128)
+
+    # the children are never waited for.
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    _logger.info('wllvm-server listening on %s', socketName)
+
+    while True:
+        try:
+            (conn, _) = server.accept()
+        except InterruptedError:
+            continue
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if os.fork() == 0:
+            server.close()
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            rc = 1
+            try:
+                rc = handleRequest(conn)
+            finally:
+                os._exit(rc)
+        conn.close()
+
+
+def receiveRequest(conn):
+    """ Reads the request and the client's stdio file descriptors.
+    """
+    fds = array.array('i')
+    lengthSize = struct.calcsize(_lengthFormat)
+    (data, ancdata, _, _) = conn.recvmsg(lengthSize, socket.CMSG_SPACE(3 * fds.itemsize))
+    for (level, kind, cmsg) in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cmsg[:len(cmsg) - (len(cmsg) % fds.itemsize)])
+    if len(data) < lengthSize:
+        rest = recvAll(conn, lengthSize - len(data))
+        if rest is None:
+            raise ConnectionError('truncated request')
+        data += rest
+    (length,) = struct.unpack(_lengthFormat, data)
+    payload = recvAll(conn, length)
+    if payload is None or len(fds) != 3:
+        raise ConnectionError('truncated request')
+    return (json.loads(payload.decode('utf-8')), list(fds))
+
+
+def handleRequest(conn):
+    """ Becomes the client's wllvm process, in the forked child. Returns the exit code.
+    """
+    (request, fds) = receiveRequest(conn)
+    for (fd, target) in zip(fds, (0, 1, 2)):
+        os.dup2(fd, target)
+        os.close(fd)
+
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    os.umask(request['umask'])
+    sys.argv = request['argv']
+    resetLogging()
+
+    try:
+        rc = wcompile(request['mode'], request['ppid'])
+    except SystemExit as e:
+        rc = e.code
+    if rc is None:
+        rc = 0
+    elif not isinstance(rc, int):
+        sys.stderr.write(f'{rc}\n')
+        rc = 1
+    sys.stdout.flush()
+    sys.stderr.flush()
+    conn.sendall(struct.pack(_exitCodeFormat, rc))
+    conn.close()
+    return 0
+
+
+def main():
+    """ The entry point to wllvm-server.
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('socket', nargs='?', default=os.getenv(serverSocketEnv),
+                        help=f'the unix socket to listen on, defaults to ${serverSocketEnv}')
+    args = parser.parse_args()
+    if not args.socket:
+        parser.error(f'no socket given, and {serverSocketEnv} is not set')
+    # so that the socket gets cleaned up.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        serve(args.socket)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        removeSocket(args.socket)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,214 @@
+""" The bitcode store.
+
+If the environment variable WLLVM_BC_STORE names a directory, every bitcode
+file we record is also put there, named by the hash of its absolute path, so
+extract-bc can still find it once the build tree is gone.
+
+Entries are written to a temporary name and renamed into place, so concurrent
+builds never see a torn entry. The temporary is a reflink of the bitcode where
+the file system can share the blocks (btrfs, xfs), and a copy otherwise. Not a
+hard link: the bitcode is not always replaced, llvm-as and a cache restore may
+rewrite it in place, and the entry would change with it. An entry that already holds the same bitcode is left alone.
+
+If WLLVM_BC_STORE_COMPRESSION is zlib or lzma, optionally followed by a
+level (zlib:9, lzma:3), entries are compressed instead, and get a .zlib or .xz
+suffix. Readers find the entry in whichever form it is, and decompress it.
+"""
+
+import os
+
+from .logconfig import logConfig
+
+# Internal logger
+_logger = logConfig(__name__)
+
+# Environmental variable naming the store directory.
+storeEnv = 'WLLVM_BC_STORE'
+
+# Environmental variable asking for compressed entries, <format>[:<level>].
+compressionEnv = 'WLLVM_BC_STORE_COMPRESSION'
+
+# format -> (entry suffix, default level, levels)
+compressionFormats = {'zlib': ('.zlib', 6, range(-1, 10)), 'lzma': ('.xz', 6, range(0, 10))}
+
+# The entry suffixes, plain first.
+entrySuffixes = ('',) + tuple(suffix for (suffix, _, _) in compressionFormats.values())
+
+# ioctl(dest, FICLONE, src) from linux/fs.h
+_FICLONE = 0x40049409
+
+
+def getHashedPathName(path):
+    import hashlib
+    return hashlib.sha256(path.encode('utf-8')).hexdigest() if path else None
+
+
+def getCompression():
+    """ Returns the (format, level) asked for by WLLVM_BC_STORE_COMPRESSION, or None.
+    """
+    value = os.getenv(compressionEnv)
+    if not value:
+        return None
+    (name, _, level) = value.partition(':')
+    if name not in compressionFormats:
+        _logger.warning('Ignoring %s = "%s", the formats are %s', compressionEnv, value, ', '.join(compressionFormats))
+        return None
+    (_, default, levels) = compressionFormats[name]
+    try:
+        level = int(level) if level else default
+    except ValueError:
+        _logger.warning('Ignoring the level in %s = "%s", it is not a number', compressionEnv, value)
+        return (name, default)
+    if level not in levels:
+        _logger.warning('Ignoring %s = "%s", %s levels go from %d to %d', compressionEnv, value, name, levels[0], levels[-1])
+        return None
+    return (name, level)
+
+
+def getEntryFormat(entry):
+    """ The compression format of a store entry, None if it is plain bitcode.
+    """
+    for (name, (suffix, _, _)) in compressionFormats.items():
+        if entry.endswith(suffix):
+            return name
+    return None
+
+
+def storeBitcodeFile(absBcPath):
+    """ Puts the bitcode file into the store, if there is one.
+    """
+    storeDir = os.getenv(storeEnv)
+    if not storeDir:
+        return
+    compression = getCompression()
+    base = os.path.join(storeDir, getHashedPathName(absBcPath))
+    entry = base + (compressionFormats[compression[0]][0] if compression else '')
+    if isSameContent(absBcPath, entry):
+        _logger.debug('The store already has "%s"', absBcPath)
+        return
+    import tempfile
+    tmpName = None
+    try:
+        # unique even when hosts or containers, whose pids repeat, share the store.
+        (fd, tmpName) = tempfile.mkstemp(dir=storeDir, suffix='.tmp')
+        os.close(fd)
+        if compression:
+            compressFile(absBcPath, tmpName, *compression)
+            method = compression[0]
+        else:
+            method = placeFile(absBcPath, tmpName)
+        os.replace(tmpName, entry)
+    except OSError as e:
+        _logger.warning('Failed to store "%s": %s', absBcPath, str(e))
+        if tmpName and os.path.exists(tmpName):
+            os.remove(tmpName)
+        return
+    # the entry in another form would be stale now, and readers might find it first.
+    for stale in (base + suffix for suffix in entrySuffixes):
+        if stale != entry and os.path.lexists(stale):
+            os.remove(stale)
+    _logger.debug('Stored "%s" as "%s" (%s)', absBcPath, entry, method)
+
+
+def compressFile(src, dst, name, level):
+    """ Compresses src into dst, the compressor's own errors are raised as OSError.
+    """
+    if name == 'zlib':
+        import zlib
+        (newCompressor, errors) = (lambda: zlib.compressobj(level), (zlib.error, ValueError))
+    else:
+        import lzma
+        (newCompressor, errors) = (lambda: lzma.LZMACompressor(preset=level), (lzma.LZMAError, ValueError))
+    try:
+        compressor = newCompressor()
+        with open(dst, 'wb') as d:
+            for chunk in readChunks(src):
+                d.write(compressor.compress(chunk))
+            d.write(compressor.flush())
+    except errors as e:
+        raise OSError(f'{name} compression failed: {e}') from e
+
+
+def readEntry(entry):
+    """ Yields the contents of a store entry in chunks, decompressed if need be.
+    """
+    name = getEntryFormat(entry)
+    if name == 'zlib':
+        import zlib
+        decompressor = zlib.decompressobj()
+    elif name == 'lzma':
+        import lzma
+        decompressor = lzma.LZMADecompressor()
+    else:
+        yield from readChunks(entry)
+        return
+    for chunk in readChunks(entry):
+        yield decompressor.decompress(chunk)
+    if name == 'zlib':
+        yield decompressor.flush()
+
+
+def readChunks(path):
+    with open(path, 'rb') as f:
+        yield from iter(lambda: f.read(1 << 20), b'')
+
+
+def decompressEntry(entry, outFile):
+    """ Writes the bitcode of a compressed entry to outFile, via a temporary and a rename.
+    """
+    import tempfile
+    (fd, tmpName) = tempfile.mkstemp(dir=os.path.dirname(outFile), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in readEntry(entry):
+            f.write(chunk)
+    os.replace(tmpName, outFile)
+
+
+def placeFile(src, dst):
+    """ Makes dst have the contents of src, as cheaply as the file system allows.
+
+    Returns how: 'reflink' or 'copy'. dst, if it exists, is overwritten.
+    """
+    try:
+        import fcntl
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            try:
+                fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+        os.remove(dst)
+    except ImportError:
+        pass
+    import shutil
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+
+def isSameContent(path, entry):
+    """ Whether the existing entry has the same contents as path: same size, then same hash.
+
+    The size of a compressed entry says nothing, so only the hash is compared.
+    """
+    try:
+        (st, entrySt) = (os.stat(path), os.stat(entry))
+    except OSError:
+        return False
+    if os.path.samestat(st, entrySt):
+        return True
+    if getEntryFormat(entry) is None and st.st_size != entrySt.st_size:
+        return False
+    try:
+        return hashChunks(readChunks(path)) == hashChunks(readEntry(entry))
+    except Exception as e:  # pylint: disable=broad-except
+        # a damaged entry: zlib.error, LZMAError, or an OSError
+        _logger.debug('Could not read "%s": %s', entry, str(e))
+        return False
+
+
+def hashChunks(chunks):
+    import hashlib
+    h = hashlib.sha256()
+    for chunk in chunks:
+        h.update(chunk)
+    return h.digest()
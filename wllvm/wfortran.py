@@ -12,13 +12,13 @@ linked into a library or executable.
 
 import sys
 
-from .compilers import wcompile
+from .client import main as clientMain
 
 
 def main():
     """ The entry point to wllvm.
     """
-    return wcompile("wfortran")
+    return clientMain("wfortran")
 
 
 if __name__ == '__main__':
@@ -10,13 +10,13 @@ into a library or executable.
 
 import sys
 
-from .compilers import wcompile
+from .client import main as clientMain
 
 
 def main():
     """ The entry point to wllvm++.
     """
-    return wcompile("wllvm++")
+    return clientMain("wllvm++")
 
 
 if __name__ == '__main__':
@@ -10,11 +10,11 @@ linked into a library or executable.
 """
 
 import sys
-from .compilers import wcompile
+from .client import main as clientMain
 def main():
     """ The entry point to wllvmrs. """
     
-    return wcompile("wllvmrs") 
+    return clientMain("wllvmrs") 
 
 if __name__ == '__main__':
     sys.exit(main())
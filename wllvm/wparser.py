@@ -8,6 +8,18 @@ It records the location of the bitcode in an
 ELF section of the object file so that it can be
 found later after all of the objects are
 linked into a library or executable.
+
+wparse-args shows how a single command line is split:
+
+    wparse-args -c foo.c -o foo.o
+
+or, with --batch, splits every command of a compile_commands.json (or of a
+JSONL file with one argv, or compile_commands.json entry, per line):
+
+    wparse-args --batch compile_commands.json > partitions.jsonl
+
+Each command becomes one JSON line on stdout. Parse throughput and the most
+common unrecognized flags are reported on stderr.
 """
 
 import sys
@@ -17,10 +29,92 @@ from .arglistfilter import ArgumentListFilter
 def main():
     cmd = list(sys.argv)
     cmd = cmd[1:]
+    if cmd and cmd[0] == '--batch':
+        return batchMain(cmd[1:])
     args = ArgumentListFilter(cmd)
     args.dump()
     return 0
 
 
+def readCommands(inputFile):
+    """ Yields the (directory, file, argv) of each command in a compile_commands.json or JSONL file.
+    """
+    import json
+    import shlex
+
+    with (sys.stdin if inputFile == '-' else open(inputFile)) as f:
+        text = f.read()
+    try:
+        # a compile_commands.json, or a JSONL file of a single line.
+        entries = json.loads(text)
+        if isinstance(entries, dict) or (entries and all(isinstance(arg, str) for arg in entries)):
+            entries = [entries]
+    except ValueError:
+        entries = (json.loads(line) for line in text.splitlines() if line.strip())
+    for entry in entries:
+        if isinstance(entry, list):
+            yield (None, None, entry)
+        elif 'arguments' in entry:
+            yield (entry.get('directory'), entry.get('file'), entry['arguments'])
+        else:
+            yield (entry.get('directory'), entry.get('file'), shlex.split(entry['command']))
+
+
+def batchMain(args):
+    """ wparse-args --batch <compile_commands.json | file.jsonl | ->
+    """
+    import json
+    import logging
+    import os
+    import time
+    from collections import Counter
+
+    if len(args) != 1:
+        sys.stderr.write('Usage: wparse-args --batch <compile_commands.json | file.jsonl | ->\n')
+        return 1
+
+    # unrecognized flags are reported in the output, and summed up at the end.
+    logging.getLogger('wllvm.arglistfilter').setLevel(logging.ERROR)
+
+    cwd = os.getcwd()
+    unrecognized = Counter()
+    (commands, arguments, parseTime) = (0, 0, 0.0)
+    try:
+        for (directory, fileName, argv) in readCommands(args[0]):
+            # @files and the like are relative to the directory of the command.
+            os.chdir(directory if directory and os.path.isdir(directory) else cwd)
+            # argv[0] is the compiler, the filter sees what comes after it.
+            start = time.perf_counter()
+            af = ArgumentListFilter(argv[1:])
+            parseTime += time.perf_counter() - start
+            (skip, reason) = af.skipBitcodeGeneration()
+            commands += 1
+            arguments += len(argv) - 1
+            unrecognized.update(af.unrecognizedArgs)
+            json.dump({
+                'directory': directory,
+                'file': fileName,
+                'compileArgs': af.compileArgs,
+                'linkArgs': af.linkArgs,
+                'inputFiles': af.inputFiles,
+                'objectFiles': af.objectFiles,
+                'outputFilename': af.outputFilename,
+                'skipReason': reason if skip else None,
+                'unrecognizedArgs': af.unrecognizedArgs,
+            }, sys.stdout)
+            sys.stdout.write('\n')
+    finally:
+        os.chdir(cwd)
+
+    rate = commands / parseTime if parseTime else 0.0
+    sys.stderr.write(f'Parsed {commands} commands ({arguments} arguments) in {parseTime:.3f}s, '
+                     f'{rate:.0f} commands/s\n')
+    if unrecognized:
+        sys.stderr.write('Most common unrecognized flags:\n')
+        for (flag, count) in unrecognized.most_common(20):
+            sys.stderr.write(f'  {count:8d}  {flag}\n')
+    return 0
+
+
 if __name__ == '__main__':
     sys.exit(main())